@@ -2,27 +2,304 @@
 import json
 import logging
 import base64
-from typing import TypedDict, List, Annotated, Sequence, Dict, Any, Optional, Literal
+import re
+import io
+from typing import TypedDict, List, Annotated, Sequence, Dict, Any, Optional, Literal, Callable, Tuple, Union, Set
 from operator import itemgetter
 import asyncio
-
-from openai import BadRequestError
+import bisect
+import contextlib
+import functools
+
+from PIL import Image
+import httpx
+import orjson
+from openai import BadRequestError, RateLimitError, APIConnectionError, APITimeoutError, InternalServerError
+from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception, retry_if_exception_type
 from langgraph.graph import StateGraph, END
 from langgraph.graph.message import add_messages
 from langchain_core.messages import BaseMessage, ToolMessage, HumanMessage, AIMessage, SystemMessage
 
 # Import Nebius client and SPECIFIC model names
-from llm_interface import nebius_client, TEXT_TOOL_MODEL_NAME, VISION_MODEL_NAME
-from tools import available_tools_definitions, tool_executor_map
+from llm_interface import (
+    nebius_client, embed_text, count_tokens, token_rate_limiter, request_rate_limiter, request_semaphore,
+    TEXT_TOOL_MODEL_NAME, VISION_MODEL_NAME, SUMMARY_MODEL_NAME, NEBIUS_TOKENS_PER_MINUTE,
+)
+from tools import available_tools_definitions, TOOLS_DEFINITIONS_JSON, ToolNotConfiguredError, tool_executor_map
+from cache import llm_cache, tool_cache, cache_key, tool_cache_key, SemanticCache, namespace_key
 
 logger = logging.getLogger(__name__)
 
+LLM_TEMPERATURE = 0.6
+# Responses at temperature 0 are deterministic and cached indefinitely (LRU-bounded);
+# otherwise they are only reused within this TTL. Set to None to disable caching for non-zero temperatures.
+LLM_CACHE_TTL_SECONDS: Optional[float] = 300
+
+# Near-duplicate prompts (e.g. rephrased FAQs) reuse a previous answer for the same system prompt/model.
+SEMANTIC_CACHE_ENABLED = True
+SEMANTIC_CACHE_MIN_PROMPT_CHARS = 20 # Shorter prompts ("yes", "ok", "tell me more") carry too little meaning to match on
+
+# History compaction: when the prompt grows past this many tokens, older turns are summarized
+HISTORY_TOKEN_THRESHOLD = 4000
+SUMMARY_KEEP_RECENT = 4 # Most recent messages always sent verbatim
+
+def _summary_message(summary: str) -> Dict[str, Any]:
+    return {"role": "system", "content": f"Summary of earlier turns: {summary}"}
+
+async def _compact_history(formatted_messages: List[Dict[str, Any]], messages: Sequence[BaseMessage], summary: Optional[str], covered: int, summarize: bool = True) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+    """
+    Replaces the `covered` oldest messages (after the system prompt) with the running `summary`, then,
+    if `summarize` and the result still exceeds HISTORY_TOKEN_THRESHOLD tokens, folds the next-oldest turns into a
+    new summary (produced by the cheaper summary model). Returns the messages to send and the state
+    update ({"history_summary", "summary_covered"}) when a new summary was made, else {}.
+    """
+    head_len = 1 if formatted_messages and formatted_messages[0].get("role") == "system" else 0
+    # formatted_messages[i] was produced from messages[origins[i]] (unknown message types are skipped when formatting)
+    origins = [i for i, msg in enumerate(messages) if type(msg) in _FORMATTERS]
+    first = bisect.bisect_left(origins, head_len + covered) # First formatted message not covered by the summary
+    head = formatted_messages[:head_len] + ([_summary_message(summary)] if summary else [])
+    compacted = head + formatted_messages[first:]
+    if not summarize or len(formatted_messages) - first <= SUMMARY_KEEP_RECENT:
+        return compacted, {}
+    total_tokens = count_tokens(compacted)
+    if total_tokens <= HISTORY_TOKEN_THRESHOLD:
+        return compacted, {}
+
+    split = len(formatted_messages) - SUMMARY_KEEP_RECENT
+    # Never start the verbatim tail on a tool result; it must follow its assistant tool call
+    while split > first and formatted_messages[split].get("role") == "tool":
+        split -= 1
+    older = formatted_messages[first:split]
+    if not older:
+        return compacted, {}
+
+    transcript = "\n".join(
+        f"{m['role']}: {m.get('content') or '[called tools: ' + ', '.join(tc['function']['name'] for tc in m.get('tool_calls', [])) + ']'}"
+        for m in older if isinstance(m.get("content"), str) or m.get("tool_calls")
+    )
+    if summary: transcript = f"Summary so far: {summary}\n{transcript}" # Extend the running summary instead of redoing it
+    summary_request = [
+        {"role": "system", "content": "Summarize the following dialogue between a farmer and an assistant. Keep facts, locations, crops, numbers and open questions. Be concise."},
+        {"role": "user", "content": transcript},
+    ]
+    logger.info(f"History at ~{total_tokens} tokens exceeds {HISTORY_TOKEN_THRESHOLD}; summarizing {len(older)} older messages.")
+    try:
+        response = await _create_completion(model=SUMMARY_MODEL_NAME, messages=summary_request, temperature=0)
+        new_summary = response.choices[0].message.content or ""
+    except Exception as e:
+        logger.warning(f"History summarization failed, sending uncompacted history: {e}")
+        return compacted, {}
+    update = {"history_summary": new_summary, "summary_covered": origins[split] - head_len}
+    return formatted_messages[:head_len] + [_summary_message(new_summary)] + formatted_messages[split:], update
+
+# --- Cheap Intent Gate ---
+# Pure greetings/small talk are answered with a canned reply instead of a full LLM round-trip.
+_GREETING_RE = re.compile(
+    r"^(hi+|hello+|hey+|halo+|hai+|helo|yo|good (morning|afternoon|evening)|selamat (pagi|siang|sore|malam)"
+    r"|xin ch[aà]o|ch[aà]o( b[aạ]n)?|สวัสดี(ครับ|ค่ะ|คะ)?|kumusta( po)?|magandang (umaga|hapon|gabi)( po)?)"
+    r"( there| bot| padichat)?[\s!.,~]*$",
+    re.IGNORECASE,
+)
+_CANNED_GREETINGS = {
+    "en": "Hi! How can I help with your crops today?",
+    "id": "Halo! Ada yang bisa saya bantu dengan tanaman Anda hari ini?",
+    "vi": "Xin chào! Hôm nay tôi có thể giúp gì cho cây trồng của bạn?",
+    "th": "สวัสดีครับ! วันนี้มีอะไรให้ช่วยเรื่องพืชผลของคุณไหมครับ?",
+    "tl": "Kumusta! Paano kita matutulungan sa iyong mga pananim ngayon?",
+}
+
+def quick_classify(text: str) -> str:
+    """Heuristic intent check on the latest user message. Returns "greeting" or "other"."""
+    return "greeting" if len(text) <= 40 and _GREETING_RE.match(text.strip()) else "other"
+
+def _standalone_prompt(messages: Sequence[BaseMessage]) -> Optional[str]:
+    """
+    Text of the latest user message if it can be answered without earlier turns (no assistant
+    message precedes it and it is long enough to be self-contained), else None. Only such
+    prompts are used with the semantic cache, whose namespace is shared by users with the same profile.
+    """
+    for i in range(len(messages) - 1, -1, -1):
+        msg = messages[i]
+        if isinstance(msg, HumanMessage):
+            if not isinstance(msg.content, str) or len(msg.content.strip()) < SEMANTIC_CACHE_MIN_PROMPT_CHARS:
+                return None
+            if any(isinstance(m, AIMessage) for m in messages[:i]):
+                return None # Follow-up: its meaning depends on the earlier conversation
+            return msg.content
+    return None
+
 # --- Agent State Definition ---
 class AgentState(TypedDict):
     messages: Annotated[Sequence[BaseMessage], add_messages]
     user_id: int
     user_profile: Dict[str, Any]
-    image_base64: Optional[str]
+    image_bytes: Optional[Union[bytes, bytearray]] # Raw photo; base64-encoded only when building the vision request
+    tool_call_args_json: Dict[str, str] # tool_call_id -> arguments JSON exactly as returned by the LLM
+    formatted_prefix: List[Dict[str, Any]] # API-formatted dicts for messages[:formatted_prefix_len]
+    formatted_prefix_len: int
+    history_summary: Optional[str] # Running summary standing in for the oldest messages (see _compact_history)
+    summary_covered: int # How many messages after the system prompt the summary replaces
+    stream_callback: Optional[Callable[[str], None]] # Receives the accumulated reply text while streaming; must not block
+
+# --- Message Formatters (LangChain message -> Nebius/OpenAI API dict) ---
+def _fmt_human(msg: HumanMessage, tool_call_args_json: Dict[str, str]) -> Dict[str, Any]:
+    # For vision model, content might be modified later if image exists
+    return {"role": "user", "content": msg.content or ""}
+
+def _fmt_ai(msg: AIMessage, tool_call_args_json: Dict[str, str]) -> Optional[Dict[str, Any]]:
+    ai_msg_data = {"role": "assistant", "content": msg.content if msg.content is not None else None}
+    if msg.tool_calls:
+         ai_msg_data["tool_calls"] = [
+              {
+                   "id": tc["id"],
+                   "type": "function",
+                   "function": {
+                        "name": tc["name"],
+                        # Reuse the LLM's own serialization when known instead of re-encoding every turn
+                        "arguments": tool_call_args_json.get(tc["id"]) or orjson.dumps(tc["args"]).decode()
+                   }
+              } for tc in msg.tool_calls ]
+         if ai_msg_data["content"] is None: del ai_msg_data["content"]
+    elif ai_msg_data["content"] is None: ai_msg_data["content"] = ""
+    if ai_msg_data.get("content") is not None or ai_msg_data.get("tool_calls"): return ai_msg_data
+    return None
+
+def _fmt_tool(msg: ToolMessage, tool_call_args_json: Dict[str, str]) -> Dict[str, Any]:
+    return { "role": "tool", "tool_call_id": msg.tool_call_id, "content": msg.content or "", "name": msg.name }
+
+def _fmt_system(msg: SystemMessage, tool_call_args_json: Dict[str, str]) -> Dict[str, Any]:
+    return {"role": "system", "content": msg.content or ""}
+
+# Exact-type dispatch: one dict lookup per message instead of an isinstance chain
+_FORMATTERS = {HumanMessage: _fmt_human, AIMessage: _fmt_ai, ToolMessage: _fmt_tool, SystemMessage: _fmt_system}
+
+# --- Image Preprocessing ---
+VISION_MAX_IMAGE_SIDE = 768 # Long-side pixel cap for images sent to the vision model
+VISION_JPEG_QUALITY = 75
+
+def _encode_image_for_vision(image_bytes: Union[bytes, bytearray]) -> str:
+    """Downscales and re-encodes raw image bytes as base64 JPEG to cut upload size; encodes the original on failure."""
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as img:
+            img.thumbnail((VISION_MAX_IMAGE_SIDE, VISION_MAX_IMAGE_SIDE))
+            buf = io.BytesIO()
+            img.convert("RGB").save(buf, "JPEG", quality=VISION_JPEG_QUALITY)
+        shrunk = buf.getvalue() if buf.tell() < len(image_bytes) else image_bytes
+        logger.debug(f"Image re-encoded for vision model: {len(image_bytes)} -> {len(shrunk)} bytes.")
+        return base64.b64encode(shrunk).decode("ascii")
+    except Exception as e:
+        logger.warning(f"Image downscale failed, sending original: {e}")
+        return base64.b64encode(image_bytes).decode("ascii")
+
+# --- Retries ---
+# Transient Nebius failures (rate limits, connection drops, timeouts, 5xx) are retried with exponential backoff
+_llm_retry = retry(
+    stop=stop_after_attempt(3),
+    wait=wait_exponential(multiplier=1, min=1, max=10),
+    retry=retry_if_exception_type((RateLimitError, APIConnectionError, APITimeoutError, InternalServerError)),
+    reraise=True,
+)
+# Tools: only transient failures (network errors, timeouts, HTTP 5xx) are retried; tools raise on failure,
+# and the error left after the last attempt is turned into the ToolMessage by _run_tool_call
+def _is_transient_tool_error(e: BaseException) -> bool:
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code >= 500
+    return isinstance(e, (httpx.TransportError, ConnectionError, asyncio.TimeoutError))
+
+_tool_retry = retry(
+    stop=stop_after_attempt(3),
+    wait=wait_exponential(multiplier=0.5, min=0.5, max=5),
+    retry=retry_if_exception(_is_transient_tool_error),
+    reraise=True,
+)
+
+async def _throttle(api_call_params: Dict[str, Any]) -> None:
+    # Throttle on estimated prompt tokens and request count before every attempt (retries consume quota too).
+    # Completion tokens are not charged: their count is unknown up front, so leave headroom in NEBIUS_TOKENS_PER_MINUTE.
+    n_tokens = min(count_tokens(api_call_params.get("messages", [])), NEBIUS_TOKENS_PER_MINUTE)
+    await request_rate_limiter.acquire()
+    await token_rate_limiter.acquire(n_tokens)
+
+@_llm_retry
+async def _create_completion(**api_call_params: Any) -> Any:
+    await _throttle(api_call_params)
+    async with request_semaphore:
+        return await nebius_client.chat.completions.create(**api_call_params)
+
+@_llm_retry
+async def _open_completion_stream(**api_call_params: Any) -> Any:
+    """Starts a streamed completion and returns it holding a request_semaphore slot; the caller releases it."""
+    await _throttle(api_call_params)
+    await request_semaphore.acquire()
+    try:
+        return await nebius_client.chat.completions.create(**api_call_params, stream=True)
+    except BaseException:
+        request_semaphore.release()
+        raise
+
+@contextlib.asynccontextmanager
+async def _completion_stream(**api_call_params: Any):
+    """
+    Streamed completion that counts against NEBIUS_MAX_CONCURRENT_REQUESTS until its body has been read:
+    create(stream=True) returns as soon as the headers arrive, so the slot can't be released there.
+    """
+    stream = await _open_completion_stream(**api_call_params)
+    try:
+        yield stream
+    finally:
+        request_semaphore.release()
+        await stream.close()
+
+@_llm_retry
+async def _embed_text(text: str) -> List[float]:
+    # Embeddings share the completions' quota, concurrency cap and retries
+    await _throttle({"messages": [{"content": text}]})
+    async with request_semaphore:
+        return await embed_text(text)
+
+# Namespaces are keyed by model and system prompt, so answers are shared by every user with the same location and language
+semantic_cache = SemanticCache(embed_fn=_embed_text, threshold=0.95)
+_semantic_store_tasks: Set["asyncio.Task[None]"] = set() # Strong references until each store finishes
+
+async def _store_semantic(namespace: str, prompt: str, content: str) -> None:
+    try: await semantic_cache.set(namespace, prompt, content)
+    except Exception as e: logger.warning(f"Semantic cache store failed: {e}")
+
+def _echoes_personal_details(content: str, user_profile: Dict[str, Any]) -> bool:
+    """True when the reply mentions the user's name, so it must not be served to other users."""
+    name = (user_profile.get('name') or "").strip()
+    return bool(name) and name.casefold() in content.casefold()
+
+@_tool_retry
+async def _invoke_tool(tool_function: Callable[..., Any], tool_args: Dict[str, Any]) -> Any:
+    # Sync tools run in a worker thread so they don't block the event loop
+    if asyncio.iscoroutinefunction(tool_function):
+        return await tool_function(**tool_args)
+    return await asyncio.to_thread(tool_function, **tool_args)
+
+# --- Streaming ---
+async def _stream_completion(api_call_params: Dict[str, Any], on_partial: Callable[[str], None]) -> Tuple[str, List[Dict[str, str]]]:
+    """
+    Streams a chat completion, forwarding the accumulated text to `on_partial` as tokens arrive
+    (a plain call: slow consumers such as Telegram edits must schedule their own work, never stall the stream).
+    Returns the full content and the tool calls reassembled from their deltas.
+    """
+    content = ""
+    tool_call_parts: Dict[int, Dict[str, str]] = {}
+    async with _completion_stream(**api_call_params) as stream:
+        async for chunk in stream:
+            if not chunk.choices: continue
+            delta = chunk.choices[0].delta
+            if delta.content:
+                content += delta.content
+                try: on_partial(content)
+                except Exception as e: logger.warning(f"Stream callback failed: {e}")
+            for tc in delta.tool_calls or []:
+                part = tool_call_parts.setdefault(tc.index, {"id": "", "name": "", "arguments": ""})
+                if tc.id: part["id"] = tc.id
+                if tc.function and tc.function.name: part["name"] += tc.function.name
+                if tc.function and tc.function.arguments: part["arguments"] += tc.function.arguments
+    return content, [tool_call_parts[i] for i in sorted(tool_call_parts)]
 
 # --- Agent Nodes ---
 # --- call_llm to select model and enable/disable tools ---
@@ -32,11 +309,12 @@ async def call_llm(state: AgentState) -> Dict[str, Any]:
     and enables tools only for the text/tool model.
     """
     messages: Sequence[BaseMessage] = state['messages']
-    image_data_b64 = state.get('image_base64')
+    image_bytes = state.get('image_bytes')
     user_profile = state.get('user_profile', {})
+    tool_call_args_json: Dict[str, str] = state.get('tool_call_args_json') or {}
 
     # --- Model and Tool Configuration based on Image Presence ---
-    if image_data_b64:
+    if image_bytes:
         model_to_use = VISION_MODEL_NAME
         tools_to_pass = None  # Gemma doesn't support tools
         tool_choice_to_pass = None # Don't specify tool choice for vision model
@@ -49,42 +327,52 @@ async def call_llm(state: AgentState) -> Dict[str, Any]:
 
     logger.info(f"Calling LLM for user {state['user_id']} with {len(messages)} messages.")
 
+    # --- Cheap Model Gate: answer trivial greetings without calling Nebius ---
+    if not image_bytes and messages and isinstance(messages[-1], HumanMessage) and isinstance(messages[-1].content, str):
+        if quick_classify(messages[-1].content) == "greeting":
+            logger.info(f"Greeting detected for user {state['user_id']}; replying without LLM call.")
+            return {"messages": [AIMessage(content=_CANNED_GREETINGS.get(user_profile.get('language'), _CANNED_GREETINGS["en"]))]}
+
+    # --- Semantic Cache Lookup (text-only, standalone turns answering a fresh user message) ---
+    semantic_namespace = None
+    semantic_prompt = _standalone_prompt(messages) if SEMANTIC_CACHE_ENABLED and not image_bytes else None
+    if semantic_prompt and isinstance(messages[0], SystemMessage):
+        semantic_namespace = namespace_key(model_to_use, messages[0].content)
+        if isinstance(messages[-1], HumanMessage):
+            try:
+                cached_content = await semantic_cache.get(semantic_namespace, semantic_prompt)
+            except Exception as e:
+                logger.warning(f"Semantic cache lookup failed: {e}")
+                cached_content = None
+            if cached_content is not None:
+                logger.info(f"Semantic cache hit for user {state['user_id']} ({model_to_use}).")
+                return {"messages": [AIMessage(content=cached_content)]}
+
     # --- Message Formatting Logic ---
-    # This logic correctly formats messages with or without images,
-    # and with or without tool calls/results in history.
-    formatted_messages = []
-    last_human_message_index = -1
-    for i, msg in enumerate(messages):
-        if isinstance(msg, HumanMessage):
-            last_human_message_index = i
-            # For vision model, content might be modified later if image exists
-            formatted_messages.append({"role": "user", "content": msg.content or ""})
-        elif isinstance(msg, AIMessage):
-            ai_msg_data = {"role": "assistant", "content": msg.content if msg.content is not None else None}
-            if msg.tool_calls:
-                 api_tool_calls = [
-                      {
-                           "id": tc.get("id"),
-                           "type": "function",
-                           "function": {
-                                "name": tc.get("name"),
-                                "arguments": json.dumps(tc.get("args", {})) if isinstance(tc.get("args"), dict) else tc.get("args", "{}")
-                           }
-                      } for tc in msg.tool_calls ]
-                 ai_msg_data["tool_calls"] = api_tool_calls
-                 if ai_msg_data["content"] is None: del ai_msg_data["content"]
-            elif ai_msg_data["content"] is None: ai_msg_data["content"] = ""
-            if ai_msg_data.get("content") is not None or ai_msg_data.get("tool_calls"): formatted_messages.append(ai_msg_data)
-        elif isinstance(msg, ToolMessage):
-            formatted_messages.append({ "role": "tool", "tool_call_id": msg.tool_call_id, "content": msg.content or "", "name": msg.name })
-        elif isinstance(msg, SystemMessage):
-             formatted_messages.append({"role": "system", "content": msg.content or ""})
-        else: logger.warning(f"Unexpected message type during formatting: {type(msg)}")
-
-    # --- Image Attachment Logic (applies ONLY if image_data_b64 is present) ---
+    # History only grows at the tail between graph steps (call_llm -> tools -> call_llm),
+    # so reuse the already-formatted prefix and only format the newly appended messages.
+    prefix_len = state.get('formatted_prefix_len') or 0
+    prefix = state.get('formatted_prefix') or []
+    if prefix_len > len(messages) or len(prefix) > prefix_len:
+        prefix_len, prefix = 0, [] # Stale prefix (history was replaced); format everything
+    formatted_messages = list(prefix)
+    for msg in messages[prefix_len:]:
+        fmt = _FORMATTERS.get(type(msg))
+        if fmt is None:
+            logger.warning(f"Unexpected message type during formatting: {type(msg)}")
+            continue
+        msg_data = fmt(msg, tool_call_args_json)
+        if msg_data is not None: formatted_messages.append(msg_data)
+    state_update = {"formatted_prefix": list(formatted_messages), "formatted_prefix_len": len(messages)}
+    last_human_message_index = next((i for i in range(len(formatted_messages) - 1, -1, -1) if formatted_messages[i]["role"] == "user"), -1)
+
+    # --- Image Attachment Logic (applies ONLY if image_bytes is present) ---
+    # Resize/base64 encoding is CPU-bound, keep it off the event loop; encode only here, at the LLM boundary
+    image_data_b64 = await asyncio.to_thread(_encode_image_for_vision, image_bytes) if image_bytes else None
     if image_data_b64 and last_human_message_index != -1:
         logger.debug("Attaching image data to the last user message for VISION model.")
-        last_msg = formatted_messages[last_human_message_index]
+        # Copy so the image never leaks into the cached formatted prefix
+        last_msg = formatted_messages[last_human_message_index] = dict(formatted_messages[last_human_message_index])
         # Ensure content is list for multimodal
         if isinstance(last_msg["content"], str): last_msg["content"] = [{"type": "text", "text": last_msg["content"]}]
         elif not isinstance(last_msg["content"], list): last_msg["content"] = [{"type": "text", "text": "Please describe the image."}]
@@ -94,20 +382,28 @@ async def call_llm(state: AgentState) -> Dict[str, Any]:
          logger.warning("Image data present but no preceding user message found. Sending image with generic prompt for VISION model.")
          formatted_messages.append({"role": "user", "content": [{"type": "text", "text": "Analyze this image."}, {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_data_b64}"}}]})
 
+    # --- History Compaction (bounds per-turn tokens for long conversations) ---
+    # The summary lives in the state, so later hops (and turns, via the handler) reuse it instead of re-summarizing.
+    # Vision turns only apply the existing summary: the image message must stay in the verbatim tail.
+    formatted_messages, summary_update = await _compact_history(
+        formatted_messages, messages, state.get('history_summary'), state.get('summary_covered') or 0, summarize=not image_bytes)
+    state_update.update(summary_update)
+
     # --- Final Checks and API Call ---
     valid_formatted_messages = [m for m in formatted_messages if m.get("role")]
     if not valid_formatted_messages:
         logger.error("No valid messages to send to LLM after formatting.");
         return {"messages": [AIMessage(content="Internal Error: No history.")]}
 
-    logger.debug(f"Formatted messages being sent to {model_to_use}:\n{json.dumps(valid_formatted_messages, indent=2)}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Formatted messages being sent to {model_to_use}:\n{json.dumps(valid_formatted_messages, indent=2)}")
 
     try:
         logger.info(f"Attempting API call to model: {model_to_use}")
         api_call_params = {
             "model": model_to_use,
             "messages": valid_formatted_messages,
-            "temperature": 0.6,
+            "temperature": LLM_TEMPERATURE,
         }
         # Conditionally add tool parameters ONLY if calling the text/tool model
         if model_to_use == TEXT_TOOL_MODEL_NAME and tools_to_pass:
@@ -118,24 +414,47 @@ async def call_llm(state: AgentState) -> Dict[str, Any]:
              logger.debug("Tool parameters excluded for VISION model API call.")
 
 
-        response = await nebius_client.chat.completions.create(**api_call_params) # Use await
-
-        message = response.choices[0].message
+        # --- Response Cache Lookup ---
+        cache_ttl = None if LLM_TEMPERATURE == 0 else LLM_CACHE_TTL_SECONDS
+        use_cache = LLM_TEMPERATURE == 0 or cache_ttl is not None
+        tools_json = TOOLS_DEFINITIONS_JSON if "tools" in api_call_params else None # Pre-serialized at import
+        key = cache_key(model_to_use, valid_formatted_messages, tools_json) if use_cache else None
+        if key:
+            cached = await llm_cache.get(key)
+            if cached is not None:
+                logger.info(f"LLM cache hit for user {state['user_id']} ({model_to_use}).")
+                return {"messages": [AIMessage(content=cached["content"], tool_calls=cached["tool_calls"])], **state_update}
+            logger.debug(f"LLM cache miss for user {state['user_id']} ({model_to_use}), key {key[:12]}.")
+
+        stream_callback = state.get('stream_callback')
+        if stream_callback:
+            # Stream tokens so the user sees the reply build up instead of waiting for the full generation
+            message_content, raw_tool_calls = await _stream_completion(api_call_params, stream_callback)
+        else:
+            response = await _create_completion(**api_call_params)
+            message = response.choices[0].message
+            message_content = message.content
+            raw_tool_calls = [{"id": tc.id, "name": tc.function.name, "arguments": tc.function.arguments} for tc in message.tool_calls or []]
 
         # --- Parse tool calls (will only be present if Llama model was called and decided to use tools) ---
         response_tool_calls = []
-        if message.tool_calls:
-            logger.info(f"LLM response from {model_to_use} includes {len(message.tool_calls)} tool call(s).")
-            for tool_call in message.tool_calls:
+        new_args_json: Dict[str, str] = {}
+        if raw_tool_calls:
+            logger.info(f"LLM response from {model_to_use} includes {len(raw_tool_calls)} tool call(s).")
+            for tool_call in raw_tool_calls:
+                if not tool_call["id"] or not tool_call["name"]:
+                    logger.warning(f"Dropping tool call without id/name from {model_to_use}: {tool_call}")
+                    continue
                 try:
-                    args_dict = json.loads(tool_call.function.arguments)
-                    response_tool_calls.append({ "id": tool_call.id, "name": tool_call.function.name, "args": args_dict })
-                except json.JSONDecodeError: logger.error(f"Failed to parse JSON arguments for tool call {tool_call.id}", exc_info=True)
-                except Exception as e: logger.error(f"Unexpected error processing tool call {tool_call.id}: {e}", exc_info=True)
+                    args_dict = json.loads(tool_call["arguments"] or "{}")
+                    response_tool_calls.append({ "id": tool_call["id"], "name": tool_call["name"], "args": args_dict })
+                    new_args_json[tool_call["id"]] = tool_call["arguments"]
+                except json.JSONDecodeError: logger.error(f"Failed to parse JSON arguments for tool call {tool_call['id']}", exc_info=True)
+                except Exception as e: logger.error(f"Unexpected error processing tool call {tool_call['id']}: {e}", exc_info=True)
         elif model_to_use == TEXT_TOOL_MODEL_NAME:
              logger.info(f"LLM response from {model_to_use} has no tool calls.")
 
-        ai_message_content = message.content if message.content is not None else ""
+        ai_message_content = message_content if message_content is not None else ""
 
         # Now create the AIMessage instance
         ai_message = AIMessage(
@@ -143,8 +462,17 @@ async def call_llm(state: AgentState) -> Dict[str, Any]:
             tool_calls=response_tool_calls
         )
 
-        logger.debug(f"LLM ({model_to_use}) response parsed into AIMessage: {ai_message}")
-        return {"messages": [ai_message]}
+        logger.debug("LLM (%s) response parsed into AIMessage: %s", model_to_use, ai_message)
+        if key:
+            await llm_cache.set(key, {"content": ai_message_content, "tool_calls": response_tool_calls}, ttl=cache_ttl)
+        # Only final text answers are reusable for paraphrased prompts (the prompt's embedding was computed by the lookup)
+        if semantic_namespace and not response_tool_calls and ai_message_content and not _echoes_personal_details(ai_message_content, user_profile):
+            # The store may need an embedding request; run it in the background so the reply isn't delayed
+            task = asyncio.create_task(_store_semantic(semantic_namespace, semantic_prompt, ai_message_content))
+            _semantic_store_tasks.add(task); task.add_done_callback(_semantic_store_tasks.discard)
+        if new_args_json:
+            return {"messages": [ai_message], "tool_call_args_json": {**tool_call_args_json, **new_args_json}, **state_update}
+        return {"messages": [ai_message], **state_update}
 
     except BadRequestError as e: # Handle specific errors more gracefully
         logger.error(f"BadRequestError calling Nebius LLM ({model_to_use}): {e}", exc_info=True)
@@ -160,6 +488,54 @@ async def call_llm(state: AgentState) -> Dict[str, Any]:
 
 
 # --- execute_tools ---
+async def _run_tool_call(tool_call: Dict[str, Any]) -> Optional[ToolMessage]:
+    """Executes a single tool call (with result caching) and wraps the result in a ToolMessage."""
+    # AIMessage normalizes tool calls to ToolCall dicts, so these keys are always present
+    tool_name = tool_call["name"]
+    tool_id = tool_call["id"]
+    tool_args = tool_call["args"]
+
+    if not tool_name or not tool_id:
+         logger.warning(f"Skipping invalid tool call structure: {tool_call}")
+         return None
+
+    logger.info(f"Attempting execution: tool='{tool_name}', id='{tool_id}', args={tool_args}")
+    tool_entry = tool_executor_map.get(tool_name)
+
+    if not tool_entry:
+        logger.error(f"Tool '{tool_name}' requested by LLM is not implemented or mapped.")
+        result = f"Error: Tool '{tool_name}' not found."
+    else:
+        tool_function, cache_ttl, cacheable = tool_entry
+        key = tool_cache_key(tool_name, tool_args) if cacheable else None
+        cached_result = await tool_cache.get(key) if key else None
+        try:
+            if cached_result is not None:
+                logger.info(f"Tool cache hit for '{tool_name}' (id='{tool_id}').")
+                result = cached_result
+            else:
+                result = await _invoke_tool(tool_function, tool_args)
+
+                logger.info(f"Tool '{tool_name}' executed successfully. Result type: {type(result)}")
+                # Ensure result is string
+                if not isinstance(result, str):
+                    try: result = orjson.dumps(result, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+                    except Exception: logger.warning(f"Failed to serialize result for tool '{tool_name}'", exc_info=True); result = repr(result)
+                if key: await tool_cache.set(key, result, ttl=cache_ttl) # Only reached on success: failures raise
+
+        except httpx.HTTPError as e: # Network/HTTP failure left after retries: expected, the traceback adds nothing
+            logger.warning(f"Tool '{tool_name}' request failed with args {tool_args}: {type(e).__name__} - {e}")
+            result = f"Error executing tool {tool_name}: {type(e).__name__} - {e}"
+        except ToolNotConfiguredError as e: # Deployment without the tool's settings: one line, no traceback
+            logger.warning(f"Tool '{tool_name}' unavailable: {e}")
+            result = f"Error executing tool {tool_name}: {e}"
+        except Exception as e:
+            logger.error(f"Error executing tool '{tool_name}' with args {tool_args}: {e}", exc_info=True)
+            result = f"Error executing tool {tool_name}: {type(e).__name__} - {e}"
+
+    logger.debug(f"Built ToolMessage: id={tool_id}, name={tool_name}, content_len={len(str(result))}")
+    return ToolMessage(content=str(result), tool_call_id=tool_id, name=tool_name)
+
 # This node is only reached if call_llm (using Llama) returns tool calls.
 async def execute_tools(state: AgentState) -> Dict[str, List[ToolMessage]]:
     messages = state['messages']
@@ -169,60 +545,28 @@ async def execute_tools(state: AgentState) -> Dict[str, List[ToolMessage]]:
         logger.warning("execute_tools called but last message has no tool calls.")
         return {"messages": []} # Return empty list, graph should handle this
 
-    tool_messages: List[ToolMessage] = []
-    logger.info(f"Executing {len(last_message.tool_calls)} tool call(s)...")
-
-    for tool_call in last_message.tool_calls:
-        tool_name = tool_call.get("name")
-        tool_id = tool_call.get("id")
-        tool_args = tool_call.get("args", {})
-
-        if not tool_name or not tool_id:
-             logger.warning(f"Skipping invalid tool call structure: {tool_call}")
-             continue
-
-        logger.info(f"Attempting execution: tool='{tool_name}', id='{tool_id}', args={tool_args}")
-        tool_function = tool_executor_map.get(tool_name)
+    logger.info(f"Executing {len(last_message.tool_calls)} tool call(s) concurrently...")
+    # Independent tool calls are I/O-bound, so run them concurrently; results keep the call order.
+    results = await asyncio.gather(*(_run_tool_call(tc) for tc in last_message.tool_calls), return_exceptions=True)
 
-        if not tool_function:
-            logger.error(f"Tool '{tool_name}' requested by LLM is not implemented or mapped.")
-            result = f"Error: Tool '{tool_name}' not found."
-        else:
-            try:
-                # Execute the tool function (await if async)
-                if asyncio.iscoroutinefunction(tool_function):
-                     result = await tool_function(**tool_args)
-                else:
-                     result = tool_function(**tool_args) # Assuming sync tools are okay if brief
-
-                logger.info(f"Tool '{tool_name}' executed successfully. Result type: {type(result)}")
-                # Ensure result is string
-                if not isinstance(result, str):
-                    try: result = json.dumps(result)
-                    except Exception: logger.warning(f"Failed to serialize result for tool '{tool_name}'", exc_info=True); result = repr(result)
-
-            except Exception as e:
-                logger.error(f"Error executing tool '{tool_name}' with args {tool_args}: {e}", exc_info=True)
-                result = f"Error executing tool {tool_name}: {type(e).__name__} - {e}"
-
-        tool_messages.append(ToolMessage(content=str(result), tool_call_id=tool_id, name=tool_name))
-        logger.debug(f"Appended ToolMessage: id={tool_id}, name={tool_name}, content_len={len(str(result))}")
+    tool_messages: List[ToolMessage] = []
+    for tool_call, result in zip(last_message.tool_calls, results):
+        if isinstance(result, asyncio.CancelledError):
+            raise result # Cancellation (e.g. the user's turn was abandoned) must propagate, not become a tool result
+        if isinstance(result, BaseException):
+            logger.error(f"Unexpected error running tool call {tool_call.get('id')}: {result}", exc_info=result)
+            result = ToolMessage(content=f"Error executing tool {tool_call.get('name')}: {type(result).__name__} - {result}", tool_call_id=tool_call.get("id"), name=tool_call.get("name"))
+        if result is not None:
+            tool_messages.append(result)
 
     return {"messages": tool_messages}
 
-# This logic correctly routes based on whether the *last* message (which would be from Llama if tools were possible) contains tool calls.
+# call_llm only ever stores validated tool calls (each has an id and name), so a truthy
+# tool_calls attribute on the last message is enough to route to execute_tools.
 def should_continue(state: AgentState) -> Literal["execute_tools", "__end__"]:
-    last_message = state['messages'][-1]
-    if isinstance(last_message, AIMessage) and last_message.tool_calls:
-        if any(tc.get("id") for tc in last_message.tool_calls):
-             logger.info("Routing: LLM requested tools -> execute_tools")
-             return "execute_tools"
-        else:
-             logger.warning("Routing: AIMessage has tool_calls attribute, but it's empty/invalid. Ending.")
-             return "__end__"
-    else:
-        logger.info("Routing: LLM provided final response or no tools requested/possible -> __end__")
-        return "__end__"
+    route = "execute_tools" if getattr(state['messages'][-1], "tool_calls", None) else "__end__"
+    logger.info(f"Routing: -> {route}")
+    return route
 
 
 # --- build_agent_graph ---
@@ -240,4 +584,10 @@ def build_agent_graph():
     return agent_executor
 
 # --- Initialize Agent ---
-agent_executor = build_agent_graph()
\ No newline at end of file
+@functools.lru_cache(maxsize=1)
+def get_agent_executor():
+    """Returns the process-wide compiled agent graph (built on first call only)."""
+    return build_agent_graph()
+
+# Compile at import so forked worker processes inherit the compiled graph instead of rebuilding it
+get_agent_executor()
\ No newline at end of file
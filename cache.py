@@ -0,0 +1,219 @@
+# cache.py
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Protocol, Tuple
+
+import numpy as np
+import orjson
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DISK_CACHE_PATH = "~/.padichat/cache/llm_cache.sqlite3"
+DISK_CACHE_MAXSIZE = 10_000 # Rows kept; the oldest writes are pruned beyond this
+
+# --- Backend Interface ---
+class CacheBackend(Protocol):
+    """Minimal async key/value interface shared by all cache backends."""
+    async def get(self, key: str) -> Optional[Any]: ...
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None: ...
+
+# --- In-Memory LRU Backend ---
+class MemoryLRUCache:
+    """Bounded in-process LRU cache with optional per-entry TTL (seconds)."""
+
+    def __init__(self, maxsize: int = 512):
+        self.maxsize = maxsize
+        self._data: "OrderedDict[str, Tuple[Optional[float], Any]]" = OrderedDict()
+
+    async def get(self, key: str) -> Optional[Any]:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at is not None and expires_at < time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+# --- Optional Redis Backend ---
+class RedisCache:
+    """Redis-backed cache (values stored as JSON). Requires the `redis` package."""
+
+    def __init__(self, url: str, prefix: str = "padichat:"):
+        import redis.asyncio as redis_asyncio # Only needed when REDIS_URL is configured
+        self._redis = redis_asyncio.from_url(url)
+        self.prefix = prefix
+
+    async def get(self, key: str) -> Optional[Any]:
+        try:
+            raw = await self._redis.get(self.prefix + key)
+        except Exception as e:
+            logger.warning(f"Redis cache get failed: {e}")
+            return None
+        return json.loads(raw) if raw is not None else None
+
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        try:
+            await self._redis.set(self.prefix + key, json.dumps(value), ex=int(ttl) if ttl else None)
+        except Exception as e:
+            logger.warning(f"Redis cache set failed: {e}")
+
+# --- Persistent Disk Backend ---
+class DiskCache:
+    """
+    SQLite-backed persistent cache (values stored as JSON) that survives restarts.
+    Mainly useful in development/testing, where identical conversations are replayed.
+    Entries use the cache's own `ttl` (None: kept until pruned), not the per-call TTL, which is sized for
+    in-memory freshness and would expire them long before a replay. At most `maxsize` rows are kept:
+    expired and oldest rows are pruned on open and every `prune_every` writes.
+    """
+
+    def __init__(self, path: str, ttl: Optional[float] = None, maxsize: int = DISK_CACHE_MAXSIZE, prune_every: int = 100):
+        path = os.path.expanduser(path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.prune_every = prune_every
+        self._writes = 0
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, expires_at REAL, value TEXT)")
+        self._prune_sync()
+        self._lock = asyncio.Lock() # One statement at a time on the shared connection
+
+    def _prune_sync(self) -> None:
+        # INSERT OR REPLACE assigns a new rowid, so rowid order is write order
+        self._conn.execute("DELETE FROM cache WHERE expires_at IS NOT NULL AND expires_at < ?", (time.time(),))
+        self._conn.execute("DELETE FROM cache WHERE rowid NOT IN (SELECT rowid FROM cache ORDER BY rowid DESC LIMIT ?)", (self.maxsize,))
+        self._conn.commit()
+
+    def _get_sync(self, key: str) -> Optional[Any]:
+        row = self._conn.execute("SELECT expires_at, value FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        expires_at, raw = row
+        if expires_at is not None and expires_at < time.time():
+            self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+            self._conn.commit()
+            return None
+        return json.loads(raw)
+
+    def _set_sync(self, key: str, value: Any) -> None:
+        expires_at = time.time() + self.ttl if self.ttl is not None else None
+        self._conn.execute("INSERT OR REPLACE INTO cache (key, expires_at, value) VALUES (?, ?, ?)", (key, expires_at, json.dumps(value)))
+        self._conn.commit()
+        self._writes += 1
+        if self._writes % self.prune_every == 0:
+            self._prune_sync()
+
+    async def get(self, key: str) -> Optional[Any]:
+        async with self._lock:
+            return await asyncio.to_thread(self._get_sync, key)
+
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        async with self._lock:
+            await asyncio.to_thread(self._set_sync, key, value) # `ttl` is ignored, see the class docstring
+
+# --- Semantic (Embedding Similarity) Cache ---
+class SemanticCache:
+    """
+    Near-duplicate prompt cache. Stores (embedding, response) pairs per namespace and
+    returns a stored response when a new prompt's cosine similarity exceeds `threshold`.
+    """
+
+    def __init__(self, embed_fn: Callable[[str], Awaitable[List[float]]], threshold: float = 0.95, maxsize: int = 1024):
+        self._embed_fn = embed_fn
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self._matrices: Dict[str, np.ndarray] = {}   # namespace -> (n, dim) matrix of unit vectors
+        self._values: Dict[str, List[Any]] = {}       # namespace -> responses aligned with matrix rows
+        self._embeddings: "OrderedDict[str, np.ndarray]" = OrderedDict() # Recent prompt embeddings (reused by set)
+
+    async def _embed(self, text: str) -> np.ndarray:
+        vector = self._embeddings.get(text)
+        if vector is None:
+            vector = np.asarray(await self._embed_fn(text), dtype=np.float32)
+            norm = np.linalg.norm(vector)
+            if norm:
+                vector /= norm
+            self._embeddings[text] = vector
+            while len(self._embeddings) > 256:
+                self._embeddings.popitem(last=False)
+        return vector
+
+    async def get(self, namespace: str, prompt: str) -> Optional[Any]:
+        matrix = self._matrices.get(namespace)
+        if matrix is None:
+            return None
+        query = await self._embed(prompt)
+        scores = matrix @ query
+        best = int(np.argmax(scores))
+        if scores[best] >= self.threshold:
+            logger.debug(f"Semantic cache hit (score={scores[best]:.3f}) in namespace {namespace[:8]}.")
+            return self._values[namespace][best]
+        return None
+
+    async def set(self, namespace: str, prompt: str, value: Any) -> None:
+        vector = await self._embed(prompt)
+        matrix = self._matrices.get(namespace)
+        if matrix is None:
+            self._matrices[namespace] = vector[np.newaxis, :]
+            self._values[namespace] = [value]
+        else:
+            self._matrices[namespace] = np.vstack((matrix, vector))[-self.maxsize:]
+            self._values[namespace] = (self._values[namespace] + [value])[-self.maxsize:]
+
+# --- Key Helpers ---
+def cache_key(model: str, messages: List[Dict[str, Any]], tools: Optional[Any]) -> str:
+    """
+    Stable SHA-256 key for an LLM request (model + formatted messages + tool definitions).
+    `tools` may be the definitions themselves or their pre-serialized JSON string.
+    """
+    # orjson emits UTF-8 bytes directly, so the payload is hashed without a separate encode step
+    payload = orjson.dumps({"model": model, "messages": messages, "tools": tools}, option=orjson.OPT_SORT_KEYS)
+    return hashlib.sha256(payload).hexdigest()
+
+def tool_cache_key(tool_name: str, tool_args: Dict[str, Any]) -> str:
+    """Stable SHA-256 key for a tool invocation (tool name + JSON-encoded arguments)."""
+    return hashlib.sha256((tool_name + json.dumps(tool_args, sort_keys=True)).encode("utf-8")).hexdigest()
+
+def namespace_key(*parts: str) -> str:
+    """Short SHA-256 digest used to partition caches (e.g. by model and system prompt)."""
+    return hashlib.sha256("\x1f".join(parts).encode("utf-8")).hexdigest()
+
+def _build_llm_cache() -> CacheBackend:
+    redis_url = os.getenv("REDIS_URL")
+    if redis_url:
+        try:
+            logger.info("Using Redis backend for LLM response cache.")
+            return RedisCache(redis_url)
+        except Exception as e:
+            logger.error(f"Failed to initialize Redis cache, falling back to memory: {e}", exc_info=True)
+    disk_cache = os.getenv("PADICHAT_DISK_CACHE") # "1" for the default location, or a path to the SQLite file
+    if disk_cache:
+        path = DEFAULT_DISK_CACHE_PATH if disk_cache == "1" else disk_cache
+        disk_ttl = os.getenv("PADICHAT_DISK_CACHE_TTL") # Seconds; unset keeps entries until pruned by size
+        try:
+            logger.info(f"Using persistent disk backend for LLM response cache: {path}")
+            return DiskCache(path, ttl=float(disk_ttl) if disk_ttl else None)
+        except Exception as e:
+            logger.error(f"Failed to open disk cache at '{path}', falling back to memory: {e}", exc_info=True)
+    return MemoryLRUCache(maxsize=512)
+
+# Shared cache for LLM responses
+llm_cache: CacheBackend = _build_llm_cache()
+# Shared cache for deterministic tool results (per-tool TTLs are declared in tools.tool_executor_map)
+tool_cache: CacheBackend = MemoryLRUCache(maxsize=256)
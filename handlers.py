@@ -1,15 +1,18 @@
 # handlers.py
 import logging
+import re
+import string
 import asyncio
-from typing import Optional, List
-import base64
-import io
-
-import telegramify_markdown
-from telegramify_markdown import customize
+import concurrent.futures
+import functools
+import time
+import weakref
+from collections import deque, OrderedDict
+from typing import Optional, List, Dict, Deque, Iterator, Tuple, Union
 
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.constants import ChatAction, ParseMode
+from telegram.error import TimedOut, NetworkError
 from telegram.ext import (
     ContextTypes,
     ConversationHandler,
@@ -20,8 +23,8 @@ from telegram.ext import (
 )
 from langchain_core.messages import HumanMessage, AIMessage, BaseMessage, ToolMessage, SystemMessage
 
-from user_profile import get_user_profile, update_user_profile, is_onboarding_complete
-from agent import agent_executor, AgentState # AgentState needed for type hint
+from user_profile import get_user_profile, update_user_profile, is_profile_complete
+from agent import get_agent_executor, AgentState # AgentState needed for type hint
 
 logger = logging.getLogger(__name__)
 
@@ -44,74 +47,327 @@ SYSTEM_PROMPT_TEMPLATE = (
     "Integrate the information and the links naturally."
 )
 
+# Template pre-split once into (literal, field) pairs, so building a prompt is a single join with no template parsing
+_SYSTEM_PROMPT_PARTS = tuple((literal, field) for literal, field, _, _ in string.Formatter().parse(SYSTEM_PROMPT_TEMPLATE))
+
+def render_system_prompt(**values) -> str:
+    """Equivalent to SYSTEM_PROMPT_TEMPLATE.format(**values) (raises KeyError for a missing field)."""
+    return "".join([literal + str(values[field]) if field is not None else literal for literal, field in _SYSTEM_PROMPT_PARTS])
+
+@functools.lru_cache(maxsize=1024)
+def _system_prompt_for(state_province: str, country: str, language_name: str) -> str:
+    """Formatted prompt shared by every user with the same location and language (also survives per-user cache misses)."""
+    return render_system_prompt(state_province=state_province, country=country, language_name=language_name)
+
 LANG_CODE_TO_NAME = {"en": "English", "id": "Bahasa Indonesia", "vi": "Vietnamese", "th": "Thai", "tl": "Tagalog"}
-customize.strict_markdown = False; customize.cite_expandable = True
+_COUNTRY_CODE_TO_NAME = {"ID": "Indonesia", "MY": "Malaysia", "PH": "Philippines", "SG": "Singapore", "TH": "Thailand", "VN": "Vietnam", "OTHER": "Other"}
 ONBOARD_LANG, ONBOARD_COUNTRY, ONBOARD_STATE = range(3)
 SELECT_SETTING, CHANGE_LANG, CHANGE_COUNTRY, CHANGE_STATE = range(10, 14)
 
+_md_mod = None
+
+def _md():
+    """Imports and configures telegramify_markdown on first use (onboarding-only sessions never need it)."""
+    global _md_mod
+    if _md_mod is None:
+        import telegramify_markdown as _m
+        from telegramify_markdown import customize
+        customize.strict_markdown = False; customize.cite_expandable = True
+        _md_mod = _m
+    return _md_mod
+
+MARKDOWN_CACHE_MAX_TEXT_LENGTH = 16_384 # Longer replies are converted directly to keep the cache's memory bounded
+
+MARKDOWN_CACHE_MAXSIZE = 512
+_MD_CACHE: "OrderedDict[str, str]" = OrderedDict() # LRU of raw reply -> MarkdownV2; only touched on the event loop
+
+_MD_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix="md") # Keeps regex-heavy formatting off the event loop
+
+async def warm_up_markdown() -> None:
+    """Imports and configures the converter on the pool at startup, so the first reply doesn't pay for it."""
+    await asyncio.get_running_loop().run_in_executor(_MD_POOL, _md)
+
+async def _markdownify_async(text: str) -> str:
+    """MarkdownV2 conversion, memoized for repeated replies: hits are served on the loop, misses convert on the pool."""
+    converted = _MD_CACHE.get(text)
+    if converted is not None: _MD_CACHE.move_to_end(text); return converted
+    converted = await asyncio.get_running_loop().run_in_executor(_MD_POOL, lambda: _md().markdownify(text))
+    if len(text) < MARKDOWN_CACHE_MAX_TEXT_LENGTH:
+        _MD_CACHE[text] = converted
+        if len(_MD_CACHE) > MARKDOWN_CACHE_MAXSIZE: _MD_CACHE.popitem(last=False)
+    return converted
+
+# Anything that can produce Markdown formatting: emphasis/code/link/strike/table/escape characters anywhere, indented
+# code, or a line starting with punctuation or an ordered-list number (lists, quotes, headings, rules). Other
+# MarkdownV2-reserved characters such as . ! ( ) = mid-line are only escaped by the converter, so they display the same unformatted.
+_MD_PROBE = re.compile(r"[*_`\[~|\\]|^ {4}|^ {0,3}(?:\t|[^\w\s]|\d+[.)])", re.MULTILINE)
+
+def _is_plain_text(text: str) -> bool:
+    """True for short replies with no Markdown formatting characters, which can be sent as-is (no parse mode)."""
+    return len(text) <= TELEGRAM_MAX_MESSAGE_LENGTH and not _MD_PROBE.search(text)
+
+_MDV2_TRANS = str.maketrans({c: "\\" + c for c in "\\_*[]()~`>#+-=|{}.!"})
+
+def escape_mdv2(text: str) -> str:
+    """Escapes every MarkdownV2 reserved character, so the text is shown literally."""
+    return text.translate(_MDV2_TRANS)
+
+async def _to_mdv2(text: str) -> str:
+    """Converts a reply to MarkdownV2: plain escaping when it uses no formatting, the full converter otherwise."""
+    if not _MD_PROBE.search(text): return escape_mdv2(text)
+    return await _markdownify_async(text)
+
 def get_profiles(context: ContextTypes.DEFAULT_TYPE) -> dict:
     return context.bot_data.setdefault("user_profiles", {})
 
+def fetch_state(context: ContextTypes.DEFAULT_TYPE, user_id: int) -> Tuple[dict, Optional[dict], bool]:
+    """(all profiles, this user's profile or None, onboarding complete) in a single pass."""
+    profiles = get_profiles(context); profile = profiles.get(user_id)
+    return profiles, profile, is_profile_complete(profile)
+
 async def send_long_message(context: ContextTypes.DEFAULT_TYPE, chat_id: int, text: str):
     """Converts LLM Markdown and sends, splitting if needed."""
-    if not text: logger.warning(f"Attempted to send empty message to chat {chat_id}"); await context.bot.send_message(chat_id=chat_id, text="..."); return
-    logger.debug("Original text from LLM:\n%s", text)
-    try: converted_text = telegramify_markdown.markdownify(text); logger.debug("Converted text:\n%s", converted_text)
-    except Exception as e: logger.error(f"Markdownify conversion error: {e}", exc_info=True); await context.bot.send_message(chat_id=chat_id, text=f"[Formatting Error]\n\n{text[:1000]}..."); return
+    if not text: logger.warning(f"Attempted to send empty message to chat {chat_id}; nothing sent."); return # Upstream bug; don't spend a round-trip on a placeholder
+    if logger.isEnabledFor(logging.DEBUG): logger.debug("Original text from LLM:\n%s", text)
+    if _is_plain_text(text): await context.bot.send_message(chat_id=chat_id, text=text); return # Nothing to convert
+    try: converted_text = await _to_mdv2(text); logger.debug("md conversion: %d -> %d chars", len(text), len(converted_text))
+    except Exception as e: logger.error(f"Markdownify conversion error: {e}", exc_info=True); converted_text = escape_mdv2(text) # Still deliver the full reply, unformatted
     if len(converted_text) <= TELEGRAM_MAX_MESSAGE_LENGTH:
-        try: await context.bot.send_message(chat_id=chat_id, text=converted_text, parse_mode=ParseMode.MARKDOWN_V2)
-        except Exception as e: logger.error(f"Error sending short converted msg: {e}", exc_info=True); await context.bot.send_message(chat_id=chat_id, text=text) # Fallback plain
+        try: await get_outbound(context).enqueue(chat_id, converted_text)
+        except Exception as e: _log_send_error("short converted msg", e); await context.bot.send_message(chat_id=chat_id, text=text) # Fallback plain
     else:
-        logger.info(f"Converted message too long ({len(converted_text)} chars). Splitting."); start = 0
-        while start < len(converted_text):
-            end_limit = start + TELEGRAM_MAX_MESSAGE_LENGTH; split_pos = converted_text.rfind('\n', start, end_limit)
-            if split_pos <= start: split_pos = end_limit
-            chunk = converted_text[start:min(split_pos, len(converted_text))]
-            try: await context.bot.send_message(chat_id=chat_id, text=chunk, parse_mode=ParseMode.MARKDOWN_V2)
-            except Exception as e: logger.error(f"Error sending converted chunk: {e}", exc_info=True); await context.bot.send_message(chat_id=chat_id, text="[Error sending part]"); break
-            start = split_pos
-            if start < len(converted_text) and converted_text[start] == '\n': start += 1
-            await asyncio.sleep(0.5)
-
-def get_language_keyboard(callback_prefix: str = "lang_") -> InlineKeyboardMarkup:
+        chunks = await asyncio.get_running_loop().run_in_executor(_MD_POOL, lambda: list(_split_chunks(converted_text))); logger.info(f"Converted message too long ({len(converted_text)} chars). Sending {len(chunks)} parts.")
+        await _send_chunks(context, chat_id, chunks)
+
+async def _send_chunks(context: ContextTypes.DEFAULT_TYPE, chat_id: int, chunks: List[str]) -> None:
+    """Hands all chunks to the chat's outbound queue at once (sent back-to-back, in order) and reports any failed part."""
+    outbound = get_outbound(context); results = await asyncio.gather(*(outbound.enqueue(chat_id, chunk) for chunk in chunks), return_exceptions=True)
+    errors = [r for r in results if isinstance(r, Exception)]
+    if errors: _log_send_error(f"{len(errors)}/{len(chunks)} converted chunks", errors[0]); await context.bot.send_message(chat_id=chat_id, text="[Error sending part]")
+
+def _split_chunks(converted_text: str, limit: int = TELEGRAM_MAX_MESSAGE_LENGTH) -> Iterator[str]:
+    """Yields Telegram-sized chunks of converted text, greedily packing whole lines (single pass); whitespace-only chunks are dropped (Telegram rejects them)."""
+    current: List[str] = []; size = 0
+    for line in converted_text.splitlines(keepends=True):
+        if size + len(line) > limit and current:
+            chunk = "".join(current); current = []; size = 0
+            chunk = chunk[:-1] if chunk.endswith("\n") else chunk # The cut newline isn't sent
+            if chunk.strip(): yield chunk
+        while len(line) > limit: # A single line longer than a message: cut after the last space (not a leading one), else hard cut
+            cut = line.rfind(" ", 1, limit) + 1 or _hard_cut(line, limit)
+            if line[:cut].strip(): yield line[:cut]
+            line = line[cut:]
+        current.append(line); size += len(line)
+    chunk = "".join(current)
+    if chunk.strip(): yield chunk
+
+def _hard_cut(line: str, limit: int) -> int:
+    """Cut position at most `limit` that doesn't split a MarkdownV2 escape (a trailing unpaired backslash)."""
+    backslashes = limit - len(line[:limit].rstrip("\\"))
+    return limit - 1 if backslashes % 2 else limit
+
+def _log_send_error(what: str, e: Exception) -> None:
+    """Expected Telegram failures (rejected markup, timeouts, network blips) get a one-line warning; only unexpected ones log a traceback."""
+    if isinstance(e, (TimedOut, NetworkError)): logger.warning(f"Error sending {what}: {type(e).__name__}: {e}") # BadRequest is a NetworkError too
+    else: logger.error(f"Error sending {what}: {e}", exc_info=True)
+
+async def _send_mdv2(bot, chat_id: int, chunk: str):
+    """Sends one MarkdownV2 chunk (RetryAfter is retried by the application's AIORateLimiter, not here)."""
+    await bot.send_message(chat_id=chat_id, text=chunk, parse_mode=ParseMode.MARKDOWN_V2)
+
+# --- Outbound Queue ---
+class OutboundQueue:
+    """
+    Per-chat ordered queue of MarkdownV2 texts. One drain task per chat sends them in order,
+    coalescing consecutive small texts into a single message while they fit Telegram's limit.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self._pending: Dict[int, Deque[Tuple[str, asyncio.Future]]] = {}
+        self._drainers: Dict[int, asyncio.Task] = {}
+
+    def enqueue(self, chat_id: int, text: str) -> asyncio.Future:
+        """Queues `text` for `chat_id`; the returned future resolves once it was sent (or raises the send error)."""
+        future = asyncio.get_running_loop().create_future()
+        self._pending.setdefault(chat_id, deque()).append((text, future))
+        if chat_id not in self._drainers: self._drainers[chat_id] = asyncio.create_task(self._drain(chat_id), name=f"outbound_{chat_id}")
+        return future
+
+    async def _drain(self, chat_id: int) -> None:
+        pending = self._pending[chat_id]
+        try:
+            while pending:
+                text, future = pending.popleft(); texts = [text]; futures = [future]; size = len(text)
+                while pending and size + 2 + len(pending[0][0]) <= TELEGRAM_MAX_MESSAGE_LENGTH:
+                    text, future = pending.popleft(); texts.append(text); futures.append(future); size += 2 + len(text)
+                try: await _send_mdv2(self.bot, chat_id, "\n\n".join(texts))
+                except Exception as e:
+                    for f in futures:
+                        if not f.done(): f.set_exception(e)
+                else:
+                    for f in futures:
+                        if not f.done(): f.set_result(None)
+        finally: # Nothing is awaited between the emptiness check and here, so no enqueue can be missed
+            del self._drainers[chat_id]
+            for _, f in self._pending.pop(chat_id, ()):
+                if not f.done(): f.cancel()
+
+_outbound: Optional[OutboundQueue] = None
+
+def get_outbound(context: ContextTypes.DEFAULT_TYPE) -> OutboundQueue:
+    # Kept at module level rather than in bot_data, which is pickled by the persistence layer
+    global _outbound
+    if _outbound is None or _outbound.bot is not context.bot: _outbound = OutboundQueue(context.bot)
+    return _outbound
+
+# --- Streaming Replies ---
+STREAM_EDIT_INTERVAL_SECONDS = 1.0 # Minimum gap between draft edits (Telegram rate-limits message edits)
+
+class StreamingDraft:
+    """Shows a streamed LLM reply as a plain-text draft message that is edited as tokens arrive."""
+
+    def __init__(self, context: ContextTypes.DEFAULT_TYPE, chat_id: int):
+        self.context = context
+        self.chat_id = chat_id
+        self.message = None
+        self._last_edit = 0.0
+        self._shown = ""
+        self._latest = ""
+        self._task: Optional[asyncio.Task] = None # The single pending send/edit
+        self._sending = False
+        self._closed = False
+
+    def update(self, partial_text: str) -> None:
+        """Agent stream callback: records the newest text; one background task sends the draft, then edits it at most once per interval."""
+        self._latest = partial_text[:TELEGRAM_MAX_MESSAGE_LENGTH]
+        if not self._closed and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._edit_loop(), name=f"draft_{self.chat_id}")
+
+    async def _edit_loop(self) -> None:
+        # Runs until the shown draft is the newest text; tokens arriving meanwhile only replace self._latest
+        while not self._closed:
+            delay = STREAM_EDIT_INTERVAL_SECONDS - (time.monotonic() - self._last_edit)
+            if delay > 0: await asyncio.sleep(delay)
+            preview = self._latest
+            if self._closed or not preview.strip() or preview == self._shown: return
+            self._last_edit = time.monotonic(); self._sending = True
+            try:
+                if self.message is None:
+                    self.message = await self.context.bot.send_message(chat_id=self.chat_id, text=preview)
+                else:
+                    await self.context.bot.edit_message_text(chat_id=self.chat_id, message_id=self.message.message_id, text=preview)
+                self._shown = preview
+            except Exception as e: logger.warning(f"Streamed draft update failed: {e}")
+            finally: self._sending = False
+
+    async def _stop_edits(self) -> None:
+        """Stops draft edits; an in-flight send is awaited so the draft message is known to finish()."""
+        self._closed = True
+        task = self._task
+        if task is None or task.done(): return
+        if not self._sending: task.cancel() # Only waiting out the interval
+        await asyncio.wait([task])
+
+    async def finish(self, text: str) -> None:
+        """Replaces the draft with the final Markdown-formatted reply (or sends it normally if no draft exists)."""
+        await self._stop_edits()
+        if self.message is None:
+            await send_long_message(self.context, self.chat_id, text); return
+        try:
+            if _is_plain_text(text):
+                if text != self._shown: # Editing to identical text is rejected by Telegram
+                    await self.context.bot.edit_message_text(chat_id=self.chat_id, message_id=self.message.message_id, text=text)
+                return
+            converted_text = await _to_mdv2(text)
+            if len(converted_text) <= TELEGRAM_MAX_MESSAGE_LENGTH:
+                await self.context.bot.edit_message_text(chat_id=self.chat_id, message_id=self.message.message_id, text=converted_text, parse_mode=ParseMode.MARKDOWN_V2)
+                return
+        except Exception as e: logger.warning(f"Could not finalize streamed draft in place: {e}")
+        # Too long for one message (or formatting failed): drop the draft and send the reply normally
+        try: await self.context.bot.delete_message(chat_id=self.chat_id, message_id=self.message.message_id)
+        except Exception as e: logger.warning(f"Failed to delete streamed draft: {e}")
+        await send_long_message(self.context, self.chat_id, text)
+
+def _build_language_keyboard(callback_prefix: str) -> InlineKeyboardMarkup:
     keyboard = [[InlineKeyboardButton("English 🇬🇧", callback_data=f'{callback_prefix}en')], [InlineKeyboardButton("Bahasa Indonesia 🇮🇩", callback_data=f'{callback_prefix}id')], [InlineKeyboardButton("Tiếng Việt 🇻🇳", callback_data=f'{callback_prefix}vi')], [InlineKeyboardButton("ภาษาไทย 🇹🇭", callback_data=f'{callback_prefix}th')], [InlineKeyboardButton("Tagalog 🇵🇭", callback_data=f'{callback_prefix}tl')], [InlineKeyboardButton("Other", callback_data=f'{callback_prefix}other')]]; return InlineKeyboardMarkup(keyboard)
 
-def get_country_keyboard(callback_prefix: str = "country_") -> InlineKeyboardMarkup:
+def _build_country_keyboard(callback_prefix: str) -> InlineKeyboardMarkup:
     countries = [("Indonesia 🇮🇩", "ID"), ("Malaysia 🇲🇾", "MY"), ("Philippines 🇵🇭", "PH"), ("Singapore 🇸🇬", "SG"), ("Thailand 🇹🇭", "TH"), ("Vietnam 🇻🇳", "VN"), ("Other", "OTHER")]; keyboard = []; row = [];
     for name, code in countries: row.append(InlineKeyboardButton(name, callback_data=f'{callback_prefix}{code}'));
     if len(row) == 2: keyboard.append(row); row = []
     if row: keyboard.append(row); return InlineKeyboardMarkup(keyboard)
 
+# Full callback_data -> (language code to save, display name, chose "Other"); one lookup per language callback
+_LANG_CHOICES = {**{code: (code, name, False) for code, name in LANG_CODE_TO_NAME.items()}, "other": ("en", "Other", True)}
+_LANG_TABLE = {f"{prefix}{code}": entry for prefix in ("onboard_lang_", "setting_select_lang_") for code, entry in _LANG_CHOICES.items()}
+
+# Keyboards are identical for every user, so one markup per callback prefix is built and shared (markups are immutable)
+_LANG_KB_CACHE: Dict[str, InlineKeyboardMarkup] = {}
+_COUNTRY_KB_CACHE: Dict[str, InlineKeyboardMarkup] = {}
+
+def get_language_keyboard(callback_prefix: str = "lang_") -> InlineKeyboardMarkup:
+    keyboard = _LANG_KB_CACHE.get(callback_prefix)
+    if keyboard is None: keyboard = _LANG_KB_CACHE[callback_prefix] = _build_language_keyboard(callback_prefix)
+    return keyboard
+
+def get_country_keyboard(callback_prefix: str = "country_") -> InlineKeyboardMarkup:
+    keyboard = _COUNTRY_KB_CACHE.get(callback_prefix)
+    if keyboard is None: keyboard = _COUNTRY_KB_CACHE[callback_prefix] = _build_country_keyboard(callback_prefix)
+    return keyboard
+
+# --- Callback Debounce ---
+CALLBACK_DEBOUNCE_SECONDS = 0.1
+_recent_callbacks: "OrderedDict[int, Tuple[str, float]]" = OrderedDict() # user_id -> (last callback data, monotonic time), oldest first
+
+def debounce_callback(window: float):
+    """Drops a callback query repeating the user's previous one within `window` seconds (e.g. a double tap, or desktop + mobile)."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            query = update.callback_query; user_id = query.from_user.id; now = time.monotonic()
+            while _recent_callbacks and now - next(iter(_recent_callbacks.values()))[1] >= window:
+                _recent_callbacks.popitem(last=False) # Expired entries can't match any more; keeps the dict bounded
+            last = _recent_callbacks.get(user_id)
+            if last is not None and last[0] == query.data:
+                await query.answer(); return None # None keeps the conversation in its current state
+            _recent_callbacks[user_id] = (query.data, now); _recent_callbacks.move_to_end(user_id)
+            return await func(update, context)
+        return wrapper
+    return decorator
+
 # --- Onboarding Handlers ---
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int | None:
-    user = update.effective_user; chat_id = update.effective_chat.id; user_id = user.id; profiles = get_profiles(context)
-    if user_id not in profiles: update_user_profile(user_id, profiles, name=user.first_name)
+    user = update.effective_user; chat_id = update.effective_chat.id; user_id = user.id; profiles, profile, complete = fetch_state(context, user_id)
+    if profile is None: update_user_profile(user_id, profiles, name=user.first_name)
     logger.info(f"/start command from user {user_id}")
-    if is_onboarding_complete(user_id, profiles):
-        profile = get_user_profile(user_id, profiles); await context.bot.send_message(chat_id=chat_id, text=f"Welcome back, {profile.get('name')}! (Loc: {profile.get('state_province')}, {profile.get('country')}. Lang: {profile.get('language')}). Send /settings to change preferences.")
-        context.user_data.pop("chat_history_dicts", None); return ConversationHandler.END
+    if complete:
+        await context.bot.send_message(chat_id=chat_id, text=f"Welcome back, {profile.get('name')}! (Loc: {profile.get('state_province')}, {profile.get('country')}. Lang: {profile.get('language')}). Send /settings to change preferences.")
+        context.user_data.pop("hist", None); context.user_data.pop("history_summary", None); return ConversationHandler.END
     else: logger.info(f"Starting/Resuming onboarding for user {user_id}."); await context.bot.send_message(chat_id=chat_id, text=f"Hello {user.first_name}! Let's set up preferences. Select language:", reply_markup=get_language_keyboard("onboard_lang_")); return ONBOARD_LANG
+@debounce_callback(CALLBACK_DEBOUNCE_SECONDS)
 async def onboard_ask_language_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    query = update.callback_query; await query.answer(); user_id = query.from_user.id; chosen_lang_code = query.data.split('_')[-1]; profiles = get_profiles(context); chosen_lang_name = LANG_CODE_TO_NAME.get(chosen_lang_code, "Other"); logger.info(f"Onboarding: User {user_id} selected lang code: {chosen_lang_code}")
-    if chosen_lang_code == "other": await query.edit_message_text(text="Using English as default."); update_user_profile(user_id, profiles, language='en')
-    else: update_user_profile(user_id, profiles, language=chosen_lang_code); await query.edit_message_text(text=f"Language set to {chosen_lang_name}.")
-    await context.bot.send_message(chat_id=query.message.chat_id, text="Now, select country:", reply_markup=get_country_keyboard("onboard_country_")); return ONBOARD_COUNTRY
+    query = update.callback_query; await query.answer(); user_id = query.from_user.id; lang_code, lang_name, is_other = _LANG_TABLE.get(query.data, ("en", "Other", True)); profiles = get_profiles(context); logger.info(f"Onboarding: User {user_id} selected lang code: {lang_code}")
+    update_user_profile(user_id, profiles, language=lang_code); ack = "Using English as default." if is_other else f"Language set to {lang_name}."
+    await query.edit_message_text(text=f"{ack}\n\nNow, select country:", reply_markup=get_country_keyboard("onboard_country_")); return ONBOARD_COUNTRY # One edit acknowledges and asks the next question
+@debounce_callback(CALLBACK_DEBOUNCE_SECONDS)
 async def onboard_ask_country_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    query = update.callback_query; await query.answer(); user_id = query.from_user.id; chosen_country_code = query.data.split('_')[-1]; profiles = get_profiles(context); country_map = {"ID": "Indonesia", "MY": "Malaysia", "PH": "Philippines", "SG": "Singapore", "TH": "Thailand", "VN": "Vietnam", "OTHER": "Other"}; chosen_country_name = country_map.get(chosen_country_code, "Other"); logger.info(f"Onboarding: User {user_id} selected country: {chosen_country_name}")
-    update_user_profile(user_id, profiles, country=chosen_country_name); await query.edit_message_text(text=f"Country set to {chosen_country_name}."); await context.bot.send_message(chat_id=query.message.chat_id, text="Finally, type state/province:"); return ONBOARD_STATE
+    query = update.callback_query; await query.answer(); user_id = query.from_user.id; chosen_country_code = query.data.rpartition('_')[2]; profiles = get_profiles(context); chosen_country_name = _COUNTRY_CODE_TO_NAME.get(chosen_country_code, "Other"); logger.info(f"Onboarding: User {user_id} selected country: {chosen_country_name}")
+    update_user_profile(user_id, profiles, country=chosen_country_name); await query.edit_message_text(text=f"Country set to {chosen_country_name}.\n\nFinally, type state/province:"); return ONBOARD_STATE
 async def onboard_ask_state_province(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user_id = update.effective_user.id; chat_id = update.effective_chat.id; state_province_text = update.message.text; profiles = get_profiles(context); logger.info(f"Onboarding: User {user_id} state/province: {state_province_text}"); update_user_profile(user_id, profiles, state_province=state_province_text); profile = get_user_profile(user_id, profiles)
-    await context.bot.send_message(chat_id=chat_id, text=f"Setup complete! Location: {profile.get('state_province')}, {profile.get('country')}. Language: {profile.get('language')}.\n\nHow can I help?"); context.user_data.pop("chat_history_dicts", None); return ConversationHandler.END
+    await context.bot.send_message(chat_id=chat_id, text=f"Setup complete! Location: {profile.get('state_province')}, {profile.get('country')}. Language: {profile.get('language')}.\n\nHow can I help?"); context.user_data.pop("hist", None); context.user_data.pop("history_summary", None); return ConversationHandler.END
 async def onboard_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
      logger.info(f"User {update.effective_user.id} cancelled onboarding."); await context.bot.send_message(chat_id=update.effective_chat.id, text="Onboarding cancelled. /start to try again."); return ConversationHandler.END
 
 # --- Settings Handlers ---
 async def settings_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    user=update.effective_user; profiles=get_profiles(context)
-    if not is_onboarding_complete(user.id, profiles): await update.message.reply_text("Complete setup via /start first."); return ConversationHandler.END
-    profile=get_user_profile(user.id, profiles); current_settings_text=f"Settings:\n- Lang: {LANG_CODE_TO_NAME.get(profile.get('language'), 'N/A')}\n- Country: {profile.get('country')}\n- State/Prov: {profile.get('state_province')}\n\nChange?"; keyboard=[[InlineKeyboardButton("Language", callback_data='setting_change_lang')], [InlineKeyboardButton("Country", callback_data='setting_change_country')], [InlineKeyboardButton("State/Province", callback_data='setting_change_state')], [InlineKeyboardButton("Cancel", callback_data='setting_cancel')]]; reply_markup=InlineKeyboardMarkup(keyboard)
+    user=update.effective_user; _, profile, complete=fetch_state(context, user.id)
+    if not complete: await update.message.reply_text("Complete setup via /start first."); return ConversationHandler.END
+    current_settings_text=f"Settings:\n- Lang: {LANG_CODE_TO_NAME.get(profile.get('language'), 'N/A')}\n- Country: {profile.get('country')}\n- State/Prov: {profile.get('state_province')}\n\nChange?"; keyboard=[[InlineKeyboardButton("Language", callback_data='setting_change_lang')], [InlineKeyboardButton("Country", callback_data='setting_change_country')], [InlineKeyboardButton("State/Province", callback_data='setting_change_state')], [InlineKeyboardButton("Cancel", callback_data='setting_cancel')]]; reply_markup=InlineKeyboardMarkup(keyboard)
     await update.message.reply_text(current_settings_text, reply_markup=reply_markup); return SELECT_SETTING
 
+@debounce_callback(CALLBACK_DEBOUNCE_SECONDS)
 async def settings_select_action_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query=update.callback_query; await query.answer(); action=query.data
     if action == 'setting_change_lang': await query.edit_message_text("Select new language:", reply_markup=get_language_keyboard("setting_select_lang_")); return CHANGE_LANG
@@ -120,20 +376,22 @@ async def settings_select_action_callback(update: Update, context: ContextTypes.
     elif action == 'setting_cancel': await query.edit_message_text("Cancelled."); return ConversationHandler.END
     else: await query.edit_message_text("Invalid. Cancelled."); return ConversationHandler.END
 
+@debounce_callback(CALLBACK_DEBOUNCE_SECONDS)
 async def settings_receive_language_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    query=update.callback_query; await query.answer(); user_id=query.from_user.id; chosen_lang_code=query.data.split('_')[-1]; profiles=get_profiles(context); chosen_lang_name=LANG_CODE_TO_NAME.get(chosen_lang_code, "Other"); logger.info(f"Settings: User {user_id} changed lang: {chosen_lang_code}")
-    lang_to_save='en' if chosen_lang_code=="other" else chosen_lang_code; update_user_profile(user_id, profiles, language=lang_to_save)
-    await query.edit_message_text(f"Language updated to {chosen_lang_name}."); context.user_data.pop("chat_history_dicts", None); return ConversationHandler.END
+    query=update.callback_query; await query.answer(); user_id=query.from_user.id; lang_code, lang_name, _ = _LANG_TABLE.get(query.data, ("en", "Other", True)); profiles=get_profiles(context); logger.info(f"Settings: User {user_id} changed lang: {lang_code}")
+    update_user_profile(user_id, profiles, language=lang_code)
+    await query.edit_message_text(f"Language updated to {lang_name}."); context.user_data.pop("hist", None); context.user_data.pop("history_summary", None); return ConversationHandler.END
 
+@debounce_callback(CALLBACK_DEBOUNCE_SECONDS)
 async def settings_receive_country_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    query=update.callback_query; await query.answer(); user_id=query.from_user.id; chosen_country_code=query.data.split('_')[-1]; profiles=get_profiles(context); country_map={"ID": "Indonesia", "MY": "Malaysia", "PH": "Philippines", "SG": "Singapore", "TH": "Thailand", "VN": "Vietnam", "OTHER": "Other"}; chosen_country_name=country_map.get(chosen_country_code, "Other"); logger.info(f"Settings: User {user_id} changed country: {chosen_country_name}")
-    update_user_profile(user_id, profiles, country=chosen_country_name); update_user_profile(user_id, profiles, state_province=None) # Clear state
+    query=update.callback_query; await query.answer(); user_id=query.from_user.id; chosen_country_code=query.data.rpartition('_')[2]; profiles=get_profiles(context); chosen_country_name=_COUNTRY_CODE_TO_NAME.get(chosen_country_code, "Other"); logger.info(f"Settings: User {user_id} changed country: {chosen_country_name}")
+    update_user_profile(user_id, profiles, country=chosen_country_name, state_province=None) # Clear state in the same write
     await query.edit_message_text(f"Country updated to {chosen_country_name}.\nType new state/province:"); return CHANGE_STATE
 
 async def settings_receive_state(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user_id=update.effective_user.id; chat_id=update.effective_chat.id; state_province_text=update.message.text; profiles=get_profiles(context); logger.info(f"Settings: User {user_id} changed state: {state_province_text}")
     update_user_profile(user_id, profiles, state_province=state_province_text)
-    await context.bot.send_message(chat_id=chat_id, text=f"State/Province updated to '{state_province_text}'."); context.user_data.pop("chat_history_dicts", None); return ConversationHandler.END
+    await context.bot.send_message(chat_id=chat_id, text=f"State/Province updated to '{state_province_text}'."); context.user_data.pop("hist", None); context.user_data.pop("history_summary", None); return ConversationHandler.END
 
 async def settings_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if update.callback_query: await update.callback_query.answer(); await update.callback_query.edit_message_text("Cancelled.")
@@ -141,98 +399,78 @@ async def settings_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     logger.info(f"User {update.effective_user.id} cancelled settings."); return ConversationHandler.END
 
 
+TYPING_REFRESH_SECONDS = 4.0 # Telegram shows a chat action for ~5s
+
+async def _keep_typing(context: ContextTypes.DEFAULT_TYPE, chat_id: int, task: asyncio.Task) -> None:
+    """Shows "typing…" until `task` finishes, refreshing the indicator periodically for long LLM turns."""
+    while not task.done():
+        try: await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
+        except Exception as e: logger.warning(f"Failed to send typing action to chat {chat_id}: {e}")
+        await asyncio.wait([task], timeout=TYPING_REFRESH_SECONDS)
+
+MAX_HISTORY_LEN = 10 # Messages sent per turn, including the system prompt (consider token limits)
+
 async def _invoke_agent_and_respond(
     context: ContextTypes.DEFAULT_TYPE,
     user_id: int,
     chat_id: int,
     user_profile: dict,
     user_message_text: Optional[str] = None,
-    image_bytes: Optional[bytes] = None
+    image_bytes: Optional[Union[bytes, bytearray]] = None
 ):
     """Loads history, adds new message/image, invokes agent, saves history, sends response."""
-    await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
-
     # --- Construct Dynamic System Prompt ---
     user_lang_code = user_profile.get('language', 'en')
     user_lang_name = LANG_CODE_TO_NAME.get(user_lang_code, 'English')
     user_country = user_profile.get('country', 'Southeast Asia')
     user_state = user_profile.get('state_province', 'unspecified region')
+    ud = context.user_data
+    ud.pop("sys_msg", None); ud.pop("_sys_prompt_fp", None) # Left in persisted user_data by older versions
+    # Not stored per user: the prompt string is shared through _system_prompt_for's cache, and wrapping it is cheap
     try:
-        dynamic_system_prompt = SYSTEM_PROMPT_TEMPLATE.format(
-            state_province=user_state, country=user_country, language_name=user_lang_name
-        )
-        logger.debug(f"Using dynamic system prompt for user {user_id}:\n{dynamic_system_prompt}") # Log the full prompt
+        dynamic_system_prompt = _system_prompt_for(user_state, user_country, user_lang_name)
+        if logger.isEnabledFor(logging.DEBUG): logger.debug("Using dynamic system prompt for user %s:\n%s", user_id, dynamic_system_prompt) # Log the full prompt
     except KeyError as e:
         logger.error(f"Failed to format system prompt template. Missing key: {e}", exc_info=True)
         # Fallback to a generic prompt if formatting fails
         dynamic_system_prompt = f"You are a helpful AI assistant. Please respond in {user_lang_name}."
+    sys_msg = SystemMessage(content=dynamic_system_prompt)
 
-    # --- History loading/reconstruction (ensure system prompt is updated/added) ---
-    history_key = "chat_history_dicts"
-    current_history_objects: List[BaseMessage] = []
-    system_prompt_in_history = False
-    if history_key in context.user_data:
-        logger.debug(f"Loading history for user {user_id} from user_data.")
-        for i, msg_dict in enumerate(context.user_data[history_key]):
-            role = msg_dict.get("role"); content = msg_dict.get("content", "")
-            # Update the first message if it's system, otherwise insert at beginning
-            if i == 0 and role == "system":
-                logger.debug("Updating existing system prompt in history.")
-                current_history_objects.append(SystemMessage(content=dynamic_system_prompt))
-                system_prompt_in_history = True
-            elif role == "user": current_history_objects.append(HumanMessage(content=content))
-            elif role == "assistant": current_history_objects.append(AIMessage(content=content, tool_calls=msg_dict.get("tool_calls", [])))
-            elif role == "tool":
-                 tool_call_id = msg_dict.get("tool_call_id"); name = msg_dict.get("name")
-                 if tool_call_id: current_history_objects.append(ToolMessage(content=content, tool_call_id=tool_call_id, name=name))
-                 else: logger.warning(f"Skipping ToolMessage dict missing tool_call_id: {msg_dict}")
-            elif role == "system": # Handle potential older system prompts not at index 0
-                 logger.warning("Found system prompt not at index 0, skipping.")
-                 pass # Skip older system prompts if not the first message
-            else: logger.warning(f"Skipping history item with unknown role: {msg_dict}")
-
-        if not system_prompt_in_history:
-            logger.debug("Prepending new system prompt to history.")
-            current_history_objects.insert(0, SystemMessage(content=dynamic_system_prompt))
-            system_prompt_in_history = True
-    else:
-        logger.debug(f"Initializing history for {user_id} with new system prompt.")
-        current_history_objects.append(SystemMessage(content=dynamic_system_prompt))
-        system_prompt_in_history = True
+    # --- History: system prompt kept separately, rolling window of recent messages in a bounded deque ---
+    hist: deque = ud.get("hist")
+    if hist is None: hist = ud["hist"] = deque(maxlen=MAX_HISTORY_LEN - 2) # Leaves room for the system prompt and the new message
+    history_tail = list(hist)
+    while history_tail and isinstance(history_tail[0], ToolMessage): history_tail.pop(0) # Its tool call was evicted
 
     # Append the new human message
     new_human_message_content = user_message_text or ("Please analyze the image provided." if image_bytes else "...")
-    if new_human_message_content != "...": # Avoid adding placeholder if no text/image
-        current_history_objects.append(HumanMessage(content=new_human_message_content))
-    elif not current_history_objects: # Should not happen if system prompt is always added
-        logger.error("Attempted to invoke agent with no messages.")
-        await context.bot.send_message(chat_id=chat_id, text="Internal error: Cannot process empty request.")
-        return
+    human_msg = HumanMessage(content=new_human_message_content) if new_human_message_content != "..." else None # Avoid adding placeholder if no text/image
+    current_history_objects: List[BaseMessage] = [sys_msg, *history_tail, *([human_msg] if human_msg else [])]
 
-
-    # Limit history length (keeping system prompt)
-    max_history_len = 10 # Adjust as needed (consider token limits)
-    if len(current_history_objects) > max_history_len:
-         logger.debug(f"History length {len(current_history_objects)} exceeds max {max_history_len}. Trimming.")
-         # Keep system prompt + last max_history_len-1 messages
-         current_history_objects = current_history_objects[:1] + current_history_objects[-max_history_len+1:]
-
-    # Encode image if provided
-    image_b64 = base64.b64encode(image_bytes).decode('utf-8') if image_bytes else None
+    # Streamed tokens are shown in a draft message that is finalized once the agent finishes
+    draft = StreamingDraft(context, chat_id)
 
     # Prepare agent input state
     agent_input_state = AgentState(
         messages=current_history_objects,
         user_id=user_id,
         user_profile=user_profile,
-        image_base64=image_b64
+        image_bytes=image_bytes,
+        tool_call_args_json={},
+        formatted_prefix=[],
+        formatted_prefix_len=0,
+        history_summary=ud.get("history_summary"),
+        summary_covered=0, # Messages folded into the summary are dropped from "hist" after each turn
+        stream_callback=draft.update
     )
 
     # Agent invocation
     response_text = None
     try:
         logger.info(f"Invoking agent for user {user_id}...")
-        final_state = await agent_executor.ainvoke(agent_input_state)
+        agent_task = asyncio.create_task(get_agent_executor().ainvoke(agent_input_state))
+        await _keep_typing(context, chat_id, agent_task) # Typing indicator runs alongside the agent, not before it
+        final_state = await agent_task
         final_messages: List[BaseMessage] = final_state.get('messages', [])
 
         if final_messages:
@@ -244,26 +482,15 @@ async def _invoke_agent_and_respond(
                  response_text = "Unexpected response format received from agent."
                  logger.warning(f"Agent execution finished, but last message was not AIMessage: {type(last_ai_message)}")
 
-             # --- Save history back ---
-             # Ensure the system prompt saved is the *latest* one used
-             history_to_save = []
-             system_prompt_saved = False
-             for msg in final_messages:
-                 msg_dict = {}
-                 if isinstance(msg, SystemMessage):
-                     if not system_prompt_saved: # Save only the first (latest) system prompt
-                          msg_dict = {"role": "system", "content": msg.content}
-                          system_prompt_saved = True
-                     else: continue # Skip older system prompts if somehow present
-                 elif isinstance(msg, HumanMessage): msg_dict = {"role": "user", "content": msg.content}
-                 elif isinstance(msg, AIMessage): msg_dict = {"role": "assistant", "content": msg.content, "tool_calls": msg.tool_calls}
-                 elif isinstance(msg, ToolMessage): msg_dict = {"role": "tool", "content": msg.content, "tool_call_id": msg.tool_call_id, "name": msg.name}
-
-                 if msg_dict: # Add if valid dict created
-                    history_to_save.append(msg_dict)
-
-             context.user_data[history_key] = history_to_save
-             logger.debug(f"Saved {len(history_to_save)} messages to history for user {user_id}.")
+             # --- Save history back: the deque evicts the oldest entries automatically ---
+             summary_covered = final_state.get('summary_covered') or 0
+             if summary_covered: # The agent summarized older turns; keep the summary and only what it doesn't cover
+                 ud["history_summary"] = final_state.get('history_summary')
+                 hist.clear(); hist.extend(final_messages[1 + summary_covered:]) # [0] is the system prompt
+             else:
+                 if human_msg: hist.append(human_msg)
+                 hist.extend(final_messages[len(current_history_objects):])
+             logger.debug(f"Saved {len(hist)} messages to history for user {user_id}.")
 
         else:
             response_text = "Sorry, I couldn't generate a response for that."
@@ -273,46 +500,58 @@ async def _invoke_agent_and_respond(
         logger.error(f"Error invoking agent or processing response for user {user_id}: {e}", exc_info=True)
         response_text = f"Sorry, a critical error occurred ({type(e).__name__}). Please try again later."
 
-    # Send final response
-    await send_long_message(context, chat_id, response_text or "...")
+    # Send final response (replacing the streamed draft, if any)
+    await draft.finish(response_text or "...")
   
+# --- Per-User Agent Workers ---
+# Entries disappear once no task holds the lock, so idle users cost nothing
+_user_locks: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+def _user_lock(user_id: int) -> asyncio.Lock:
+    lock = _user_locks.get(user_id)
+    if lock is None: lock = _user_locks[user_id] = asyncio.Lock()
+    return lock
+
+async def _run_agent_locked(lock: asyncio.Lock, **kwargs) -> None:
+    """Runs one agent turn after any earlier turn of the same user has finished."""
+    async with lock: await _invoke_agent_and_respond(**kwargs)
+
 # --- Regular Message Handler ---
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handles regular text messages using the refactored agent invocation."""
     user = update.effective_user; chat_id = update.effective_chat.id; user_id = user.id
-    message_text = update.message.text; profiles = get_profiles(context)
+    message_text = update.message.text; _, user_profile, complete = fetch_state(context, user_id)
 
-    if not user_id in profiles or not is_onboarding_complete(user_id, profiles):
+    if not complete:
         logger.warning(f"Message from non-onboarded user {user_id}: '{message_text}'")
         await context.bot.send_message(chat_id=chat_id, text="Please use /start to complete setup.")
         return
 
-    user_profile = get_user_profile(user_id, profiles)
     logger.info(f"Handling text message from {user_id} ({user_profile.get('name')})")
 
-    # Call the refactored function
-    await _invoke_agent_and_respond(
+    # Run the agent in the background so other users' updates keep flowing; the per-user lock keeps this user's turns in order
+    context.application.create_task(_run_agent_locked(
+        _user_lock(user_id),
         context=context,
         user_id=user_id,
         chat_id=chat_id,
         user_profile=user_profile,
         user_message_text=message_text,
         image_bytes=None # No image for text messages
-    )
+    ), update=update)
 
 
 # --- NEW Photo Handler ---
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handles photo messages, downloads image, and calls the agent."""
     user = update.effective_user; chat_id = update.effective_chat.id; user_id = user.id
-    profiles = get_profiles(context)
+    _, user_profile, complete = fetch_state(context, user_id)
 
-    if not user_id in profiles or not is_onboarding_complete(user_id, profiles):
+    if not complete:
         logger.warning(f"Photo from non-onboarded user {user_id}")
         await context.bot.send_message(chat_id=chat_id, text="Please use /start to complete setup before sending photos.")
         return
 
-    user_profile = get_user_profile(user_id, profiles)
     caption = update.message.caption or "Please analyze this crop image for diseases." # Use caption or default text
     logger.info(f"Handling photo from {user_id} ({user_profile.get('name')}). Caption: '{caption}'")
 
@@ -322,36 +561,41 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     try:
         # Download the photo file content
         photo_file = await context.bot.get_file(photo.file_id)
-        # Use io.BytesIO to handle the downloaded bytes
-        with io.BytesIO() as file_stream:
-             await photo_file.download_to_memory(out=file_stream)
-             image_bytes = file_stream.getvalue()
+        # Download straight into one buffer (BytesIO + getvalue() would hold the image twice)
+        image_bytes = await photo_file.download_as_bytearray()
         logger.info(f"Successfully downloaded photo {photo.file_id} ({len(image_bytes)} bytes)")
     except Exception as e:
         logger.error(f"Failed to download photo {photo.file_id} for user {user_id}: {e}", exc_info=True)
         await context.bot.send_message(chat_id=chat_id, text="Sorry, I couldn't download the image you sent. Please try again.")
         return
 
-    # Call the refactored function with image data
-    await _invoke_agent_and_respond(
+    # Call the refactored function with image data (in the background, ordered per user)
+    context.application.create_task(_run_agent_locked(
+        _user_lock(user_id),
         context=context,
         user_id=user_id,
         chat_id=chat_id,
         user_profile=user_profile,
         user_message_text=caption,
         image_bytes=image_bytes
-    )
+    ), update=update)
 
 # Error handler (remains the same)
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     logger.error(f"Update {update} caused error {context.error}", exc_info=context.error)
 
+def _prefix(prefix: str):
+    """Callback-data matcher: a plain startswith check instead of a regex match per callback query."""
+    return lambda data: isinstance(data, str) and data.startswith(prefix)
+
+_PAT_SETTING_ENTRY = re.compile(r'^setting_(?:change_(?:lang|country|state)|cancel)$') # Exactly the settings menu buttons, one anchored match
+
 # --- Onboarding Conversation Handler Definition (using ONBOARD_ states) ---
 onboarding_conversation = ConversationHandler(
     entry_points=[CommandHandler('start', start)],
     states={
-        ONBOARD_LANG: [CallbackQueryHandler(onboard_ask_language_callback, pattern='^onboard_lang_')],
-        ONBOARD_COUNTRY: [CallbackQueryHandler(onboard_ask_country_callback, pattern='^onboard_country_')],
+        ONBOARD_LANG: [CallbackQueryHandler(onboard_ask_language_callback, pattern=_prefix('onboard_lang_'))],
+        ONBOARD_COUNTRY: [CallbackQueryHandler(onboard_ask_country_callback, pattern=_prefix('onboard_country_'))],
         ONBOARD_STATE: [MessageHandler(filters.TEXT & ~filters.COMMAND, onboard_ask_state_province)],
     },
     fallbacks=[CommandHandler('cancel', onboard_cancel)],
@@ -362,11 +606,11 @@ onboarding_conversation = ConversationHandler(
 settings_conversation = ConversationHandler(
     entry_points=[CommandHandler('settings', settings_start)],
     states={
-        SELECT_SETTING: [CallbackQueryHandler(settings_select_action_callback, pattern='^setting_change_|^setting_cancel$')],
-        CHANGE_LANG: [CallbackQueryHandler(settings_receive_language_callback, pattern='^setting_select_lang_')],
-        CHANGE_COUNTRY: [CallbackQueryHandler(settings_receive_country_callback, pattern='^setting_select_country_')],
+        SELECT_SETTING: [CallbackQueryHandler(settings_select_action_callback, pattern=_PAT_SETTING_ENTRY)],
+        CHANGE_LANG: [CallbackQueryHandler(settings_receive_language_callback, pattern=_prefix('setting_select_lang_'))],
+        CHANGE_COUNTRY: [CallbackQueryHandler(settings_receive_country_callback, pattern=_prefix('setting_select_country_'))],
         CHANGE_STATE: [MessageHandler(filters.TEXT & ~filters.COMMAND, settings_receive_state)],
     },
-    fallbacks=[CommandHandler('cancel', settings_cancel), CallbackQueryHandler(settings_cancel, pattern='^setting_cancel$')],
+    fallbacks=[CommandHandler('cancel', settings_cancel), CallbackQueryHandler(settings_cancel, pattern=lambda d: d == 'setting_cancel')],
      name="settings_flow",
 )
\ No newline at end of file
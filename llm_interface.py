@@ -1,10 +1,30 @@
 # llm_interface.py
 import os
+import logging
+from typing import Any, Dict, List
+import asyncio
+import httpx
+import tiktoken
+from aiolimiter import AsyncLimiter
 from openai import AsyncOpenAI
 
+logger = logging.getLogger(__name__)
+
 # --- Model Definitions ---
 TEXT_TOOL_MODEL_NAME = "meta-llama/Meta-Llama-3.1-70B-Instruct-fast"
 VISION_MODEL_NAME = "google/gemma-3-27b-it-fast"
+EMBEDDING_MODEL_NAME = "BAAI/bge-en-icl"
+SUMMARY_MODEL_NAME = "meta-llama/Meta-Llama-3.1-8B-Instruct-fast" # Cheaper model for history compaction
+
+# --- Client-Side Rate Limits (size to the Nebius account's quotas) ---
+NEBIUS_TOKENS_PER_MINUTE = int(os.getenv("NEBIUS_TOKENS_PER_MINUTE", "200000"))
+NEBIUS_REQUESTS_PER_MINUTE = int(os.getenv("NEBIUS_REQUESTS_PER_MINUTE", "300"))
+NEBIUS_MAX_CONCURRENT_REQUESTS = 16
+
+# Shared across all users so concurrent turns are throttled globally instead of tripping 429s
+token_rate_limiter = AsyncLimiter(NEBIUS_TOKENS_PER_MINUTE, 60)
+request_rate_limiter = AsyncLimiter(NEBIUS_REQUESTS_PER_MINUTE, 60)
+request_semaphore = asyncio.Semaphore(NEBIUS_MAX_CONCURRENT_REQUESTS)
 
 # --- Nebius OpenAI Client Configuration ---
 def get_nebius_client() -> AsyncOpenAI:
@@ -13,15 +33,69 @@ def get_nebius_client() -> AsyncOpenAI:
     if not api_key:
         raise ValueError("NEBIUS_API_KEY not found in environment variables.")
 
+    # Shared connection pool so keep-alive connections are reused across calls (avoids a TCP+TLS handshake per request);
+    # HTTP/2 multiplexes concurrent completions over the same connection
+    http_client = httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=100, keepalive_expiry=30.0),
+        timeout=httpx.Timeout(60.0, connect=10.0),
+    )
     client = AsyncOpenAI(
         base_url="https://api.studio.nebius.com/v1/",
         api_key=api_key,
+        http_client=http_client,
+        max_retries=0, # Retries/backoff are handled by the agent (tenacity) so attempts aren't multiplied
     )
     return client
 
 # Initialize client globally or create on demand
 nebius_client: AsyncOpenAI = get_nebius_client() # Add type hint for clarity
 
+# --- Token Estimation ---
+_token_encoding = None # Loaded off the event loop by warm_up_tokenizer (tiktoken may download the encoding)
+
+def _load_token_encoding() -> None:
+    global _token_encoding
+    try: _token_encoding = tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        logger.warning(f"tiktoken unavailable, estimating tokens from length: {e}")
+        _token_encoding = False # Don't retry the download
+
+async def warm_up_tokenizer() -> None:
+    """Loads the tiktoken encoding in a worker thread at startup; until then count_tokens estimates from length."""
+    await asyncio.to_thread(_load_token_encoding)
+
+def count_tokens(messages: List[Dict[str, Any]]) -> int:
+    """
+    Approximate token count of OpenAI-style chat messages. Nebius models use their own
+    tokenizers, so cl100k_base is used as a close estimate (falls back to chars/4).
+    """
+    texts = []
+    for m in messages:
+        content = m.get("content")
+        if isinstance(content, str): texts.append(content)
+        elif isinstance(content, list): texts.extend(part.get("text", "") for part in content if isinstance(part, dict))
+        for tc in m.get("tool_calls") or []: texts.append(tc.get("function", {}).get("arguments", ""))
+    text = "\n".join(texts)
+    if _token_encoding:
+        return len(_token_encoding.encode(text)) + 4 * len(messages) # Small per-message overhead
+    return len(text) // 4 + 4 * len(messages)
+
+async def warm_up_connection() -> None:
+    """Issues a cheap list-models request so the first user-facing call skips the TCP+TLS handshake."""
+    try:
+        await nebius_client.models.list()
+        logger.info("Nebius connection pool warmed up.")
+    except Exception as e:
+        logger.warning(f"Nebius warm-up request failed (first LLM call will connect cold): {e}")
+
+async def embed_text(text: str) -> List[float]:
+    """Returns the Nebius embedding vector for a single piece of text."""
+    response = await nebius_client.embeddings.create(model=EMBEDDING_MODEL_NAME, input=text)
+    return response.data[0].embedding
+
 print(f"LLM Interface Configured (Async Client):") # Update print statement
 print(f"  Text/Tool Model: {TEXT_TOOL_MODEL_NAME}")
-print(f"  Vision Model:    {VISION_MODEL_NAME}")
\ No newline at end of file
+print(f"  Vision Model:    {VISION_MODEL_NAME}")
+print(f"  Embedding Model: {EMBEDDING_MODEL_NAME}")
+print(f"  Summary Model:   {SUMMARY_MODEL_NAME}")
\ No newline at end of file
@@ -1,12 +1,17 @@
 # main.py
+import asyncio
 import logging
 import os
+import sys
 from dotenv import load_dotenv
 
-from telegram.ext import Application, MessageHandler, filters, PicklePersistence
+from telegram.ext import AIORateLimiter, Application, ContextTypes, MessageHandler, filters
+from telegram.request import HTTPXRequest
 
-from user_profile import load_user_profiles, save_user_profiles # Need save for shutdown
-from handlers import onboarding_conversation, handle_message, error_handler, settings_conversation, handle_photo
+from llm_interface import warm_up_connection, warm_up_tokenizer
+from persistence import SQLitePersistence
+from user_profile import load_user_profiles, flush_user_profiles, PROFILE_FLUSH_INTERVAL_SECONDS
+from handlers import onboarding_conversation, handle_message, error_handler, settings_conversation, handle_photo, warm_up_markdown
 
 # --- Logging Setup ---
 logging.basicConfig(
@@ -18,14 +23,49 @@ logging.getLogger("langgraph").setLevel(logging.INFO) # Adjust LangGraph verbosi
 logger = logging.getLogger(__name__)
 
 # --- Persistence Setup ---
-# Use PicklePersistence to save context.user_data and context.bot_data
-# This saves chat history and loaded profiles across restarts.
-persistence = PicklePersistence(filepath="bot_persistence.pkl")
+# Use SQLite-backed persistence to save context.user_data and context.bot_data
+# This saves chat history and loaded profiles across restarts (one row per user, so flushes only rewrite what changed).
+persistence = SQLitePersistence(filepath="bot_persistence.db")
+
+WEBHOOK_PATH = "telegram" # URL path the webhook server listens on when WEBHOOK_URL is set
+
+# --- Profile Flushing ---
+async def flush_profiles_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Periodically writes profile changes to disk (profile updates only mark them dirty)."""
+    await flush_user_profiles(context.bot_data.get("user_profiles", {}))
+
+# --- Startup/Shutdown Hooks ---
+async def post_init(application: Application) -> None:
+    """Runs once after the application is initialized, before polling starts."""
+    # Prime the Nebius keep-alive pool in the background so startup isn't delayed
+    application.create_task(warm_up_connection(), name="nebius_warm_up")
+    application.create_task(warm_up_markdown(), name="markdown_warm_up")
+    application.create_task(warm_up_tokenizer(), name="tokenizer_warm_up")
+    application.job_queue.run_repeating(flush_profiles_job, interval=PROFILE_FLUSH_INTERVAL_SECONDS, name="flush_profiles")
+
+async def post_shutdown(application: Application) -> None:
+    """Writes any profile changes still pending when the bot stops."""
+    logger.info("Flushing pending profile changes on shutdown...")
+    await flush_user_profiles(application.bot_data.get("user_profiles", {}))
+
+# --- Event Loop ---
+def install_uvloop() -> None:
+    """Runs the bot on uvloop's faster libuv-based event loop when available (not supported on Windows)."""
+    if sys.platform == "win32":
+        return
+    try:
+        import uvloop # Optional speed-up; the default asyncio loop is used without it
+    except ImportError:
+        logger.info("uvloop not installed; using the default asyncio event loop.")
+        return
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    logger.info("Using uvloop event loop.")
 
 # --- Main Bot Execution ---
 def main() -> None:
     """Start the bot."""
     load_dotenv()
+    install_uvloop() # Before the Application is built, so every loop it creates is a uvloop loop
     token = os.getenv("TELEGRAM_BOT_TOKEN")
     api_key = os.getenv("NEBIUS_API_KEY") # Check if key loaded
 
@@ -36,8 +76,10 @@ def main() -> None:
         logger.warning("NEBIUS_API_KEY not found in .env file! LLM calls will fail.")
         # Decide if you want to exit or run without LLM: return
 
-    # Create the Application with persistence
-    application = Application.builder().token(token).persistence(persistence).build()
+    # Create the Application with persistence and Telegram flood-control limits
+    # (30 msg/s overall, 20 msg/min per group; sends that still hit RetryAfter are retried up to 3 times)
+    # Outbound Bot API calls share one HTTP/2 connection pool so chunked replies and concurrent users' sends multiplex
+    application = Application.builder().token(token).persistence(persistence).request(HTTPXRequest(http_version="2")).rate_limiter(AIORateLimiter(overall_max_rate=30, overall_time_period=1, max_retries=3)).post_init(post_init).post_shutdown(post_shutdown).build()
 
     # --- Load Profiles into Bot Data (if not handled by persistence) ---
     # Persistence might handle loading bot_data automatically.
@@ -58,14 +100,21 @@ def main() -> None:
     application.add_error_handler(error_handler)
 
     # --- Start Bot ---
-    logger.info("Starting bot polling...")
-    application.run_polling()
-
-    # --- Save Profiles on Shutdown ---
-    # Polling runs indefinitely, this might not be hit easily unless stopped gracefully.
-    # Persistence handles saving, but manual save can be a backup.
-    logger.info("Attempting to save profiles on shutdown...")
-    save_user_profiles(application.bot_data.get("user_profiles", {}))
+    # Pending profile changes are flushed by post_shutdown in either mode
+    webhook_url = os.getenv("WEBHOOK_URL") # Public HTTPS base URL; Telegram pushes updates there instead of being polled
+    if webhook_url:
+        port = int(os.getenv("PORT", "8443"))
+        logger.info(f"Starting bot webhook on port {port}...")
+        application.run_webhook(
+            listen="0.0.0.0",
+            port=port,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{webhook_url.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=os.getenv("WEBHOOK_SECRET"), # Lets the server reject requests that didn't come from Telegram
+        )
+    else:
+        logger.info("Starting bot polling...")
+        application.run_polling()
 
 
 if __name__ == '__main__':
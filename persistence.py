@@ -0,0 +1,144 @@
+# persistence.py
+import asyncio
+import json
+import logging
+import os
+import pickle
+import sqlite3
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PERSISTENCE_PATH = "bot_persistence.db"
+
+ConversationKey = Tuple[Union[int, str], ...]
+CallbackData = Tuple[List[Tuple[str, float, Dict[str, Any]]], Dict[str, str]]
+
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS user_data (id INTEGER PRIMARY KEY, data BLOB NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS chat_data (id INTEGER PRIMARY KEY, data BLOB NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS singletons (name TEXT PRIMARY KEY, data BLOB NOT NULL)", # bot_data, callback_data
+    "CREATE TABLE IF NOT EXISTS conversations (name TEXT NOT NULL, key TEXT NOT NULL, state BLOB NOT NULL, PRIMARY KEY (name, key))",
+)
+
+def _dumps(obj: Any) -> bytes:
+    return pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+
+class SQLitePersistence(BasePersistence):
+    """
+    PTB persistence backed by SQLite, storing one row per user/chat/conversation so each
+    flush only rewrites the entries that changed (PicklePersistence rewrites the whole file).
+    Objects are pickled on the event loop (they may be mutated concurrently); disk I/O runs in a thread.
+    """
+
+    def __init__(self, filepath: str = DEFAULT_PERSISTENCE_PATH, store_data: Optional[PersistenceInput] = None, update_interval: float = 60):
+        super().__init__(store_data=store_data, update_interval=update_interval)
+        self.filepath = os.path.expanduser(filepath)
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = asyncio.Lock() # One statement at a time on the shared connection
+        self._singletons: Dict[str, bytes] = {} # Last written blob, to skip unchanged bot/callback data
+
+    # --- Connection Helpers ---
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.filepath, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            for statement in _SCHEMA:
+                self._conn.execute(statement)
+            self._conn.commit()
+        return self._conn
+
+    def _fetch_sync(self, sql: str, params: Tuple = ()) -> list:
+        return self._connect().execute(sql, params).fetchall()
+
+    def _write_sync(self, sql: str, params: Tuple) -> None:
+        conn = self._connect()
+        conn.execute(sql, params)
+        conn.commit()
+
+    async def _fetch(self, sql: str, params: Tuple = ()) -> list:
+        async with self._lock:
+            return await asyncio.to_thread(self._fetch_sync, sql, params)
+
+    async def _write(self, sql: str, params: Tuple) -> None:
+        async with self._lock:
+            await asyncio.to_thread(self._write_sync, sql, params)
+
+    async def _get_singleton(self, name: str) -> Optional[Any]:
+        rows = await self._fetch("SELECT data FROM singletons WHERE name = ?", (name,))
+        if not rows:
+            return None
+        self._singletons[name] = rows[0][0]
+        return pickle.loads(rows[0][0])
+
+    async def _update_singleton(self, name: str, data: Any) -> None:
+        blob = _dumps(data)
+        if self._singletons.get(name) == blob:
+            return
+        await self._write("INSERT OR REPLACE INTO singletons (name, data) VALUES (?, ?)", (name, blob))
+        self._singletons[name] = blob
+
+    # --- Loading ---
+    async def get_user_data(self) -> Dict[int, Dict[Any, Any]]:
+        return {row[0]: pickle.loads(row[1]) for row in await self._fetch("SELECT id, data FROM user_data")}
+
+    async def get_chat_data(self) -> Dict[int, Dict[Any, Any]]:
+        return {row[0]: pickle.loads(row[1]) for row in await self._fetch("SELECT id, data FROM chat_data")}
+
+    async def get_bot_data(self) -> Dict[Any, Any]:
+        data = await self._get_singleton("bot_data")
+        return data if data is not None else {}
+
+    async def get_callback_data(self) -> Optional[CallbackData]:
+        return await self._get_singleton("callback_data")
+
+    async def get_conversations(self, name: str) -> Dict[ConversationKey, object]:
+        rows = await self._fetch("SELECT key, state FROM conversations WHERE name = ?", (name,))
+        return {tuple(json.loads(key)): pickle.loads(state) for key, state in rows}
+
+    # --- Updating ---
+    async def update_user_data(self, user_id: int, data: Dict[Any, Any]) -> None:
+        await self._write("INSERT OR REPLACE INTO user_data (id, data) VALUES (?, ?)", (user_id, _dumps(data)))
+
+    async def update_chat_data(self, chat_id: int, data: Dict[Any, Any]) -> None:
+        await self._write("INSERT OR REPLACE INTO chat_data (id, data) VALUES (?, ?)", (chat_id, _dumps(data)))
+
+    async def update_bot_data(self, data: Dict[Any, Any]) -> None:
+        await self._update_singleton("bot_data", data)
+
+    async def update_callback_data(self, data: CallbackData) -> None:
+        await self._update_singleton("callback_data", data)
+
+    async def update_conversation(self, name: str, key: ConversationKey, new_state: Optional[object]) -> None:
+        key_json = json.dumps(list(key))
+        if new_state is None: # Conversation ended
+            await self._write("DELETE FROM conversations WHERE name = ? AND key = ?", (name, key_json))
+        else:
+            await self._write("INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)", (name, key_json, _dumps(new_state)))
+
+    async def drop_user_data(self, user_id: int) -> None:
+        await self._write("DELETE FROM user_data WHERE id = ?", (user_id,))
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        await self._write("DELETE FROM chat_data WHERE id = ?", (chat_id,))
+
+    # --- Refreshing (data is kept in memory by the Application; nothing to pull) ---
+    async def refresh_user_data(self, user_id: int, user_data: Dict[Any, Any]) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Dict[Any, Any]) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: Dict[Any, Any]) -> None:
+        pass
+
+    # --- Shutdown ---
+    async def flush(self) -> None:
+        async with self._lock:
+            if self._conn is not None:
+                await asyncio.to_thread(self._conn.close)
+                self._conn = None
+        logger.info(f"Persistence flushed to '{self.filepath}'.")
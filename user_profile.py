@@ -1,51 +1,113 @@
 # user_profile.py
+import asyncio
 import json
 import logging
 import os
-from typing import Dict, Any, Optional
+import tempfile
+import orjson
+from typing import Dict, Any, List, Optional, Set, Tuple
 
 logger = logging.getLogger(__name__)
-PROFILE_FILE = "user_profiles.json"
+PROFILE_DIR = "profiles" # One JSON file per user: profiles/{user_id}.json
+LEGACY_PROFILE_FILE = "user_profiles.json" # Single-file layout, migrated into PROFILE_DIR on first load
+PROFILE_FLUSH_INTERVAL_SECONDS = 10 # How often pending profile changes are written to disk
 
-def load_user_profiles() -> Dict[int, Dict[str, Any]]:
-    """Loads user profiles from the JSON file."""
-    if not os.path.exists(PROFILE_FILE):
-        logger.warning(f"Profile file '{PROFILE_FILE}' not found. Starting with empty profiles.")
-        return {}
+_dirty_user_ids: Set[int] = set() # Filled by update_user_profile, drained by flush_user_profiles
+
+def _profile_path(user_id: int) -> str:
+    return os.path.join(PROFILE_DIR, f"{user_id}.json")
+
+def _load_legacy_profiles() -> Dict[int, Dict[str, Any]]:
+    """Reads the old single-file layout and queues every profile to be written as its own file."""
     try:
-        with open(PROFILE_FILE, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            return {int(k): v for k, v in data.items()}
-    except json.JSONDecodeError:
-        logger.error(f"Error decoding JSON from '{PROFILE_FILE}'. Starting with empty profiles.", exc_info=True)
-        return {}
+        with open(LEGACY_PROFILE_FILE, 'rb') as f:
+            raw = f.read()
+        profiles = {int(k): v for k, v in orjson.loads(raw).items()} if raw.strip() else {}
     except Exception as e:
-        logger.error(f"Failed to load profiles from '{PROFILE_FILE}': {e}", exc_info=True)
+        logger.error(f"Failed to load legacy profiles from '{LEGACY_PROFILE_FILE}': {e}", exc_info=True)
         return {}
+    _dirty_user_ids.update(profiles)
+    logger.info(f"Migrating {len(profiles)} profiles from '{LEGACY_PROFILE_FILE}' to '{PROFILE_DIR}/'.")
+    return profiles
 
-def save_user_profiles(profiles: Dict[int, Dict[str, Any]]) -> None:
-    """Saves the current user profiles to the JSON file."""
+def load_user_profiles() -> Dict[int, Dict[str, Any]]:
+    """Loads user profiles from the per-user JSON files."""
+    if not os.path.isdir(PROFILE_DIR):
+        if os.path.exists(LEGACY_PROFILE_FILE):
+            return _load_legacy_profiles()
+        logger.warning(f"Profile directory '{PROFILE_DIR}' not found. Starting with empty profiles.")
+        return {}
+    profiles: Dict[int, Dict[str, Any]] = {}
+    with os.scandir(PROFILE_DIR) as entries:
+        for entry in entries:
+            stem, ext = os.path.splitext(entry.name)
+            if ext != ".json" or not stem.lstrip("-").isdigit():
+                continue
+            try:
+                with open(entry.path, 'rb') as f:
+                    profiles[int(stem)] = orjson.loads(f.read())
+            except json.JSONDecodeError:
+                logger.error(f"Error decoding JSON from '{entry.path}'. Skipping this profile.", exc_info=True)
+            except Exception as e:
+                logger.error(f"Failed to load profile from '{entry.path}': {e}", exc_info=True)
+    return profiles
+
+def _write_profile_file(user_id: int, data: bytes) -> bool:
+    """
+    Atomically writes one user's serialized profile (temp file + os.replace, so readers never see a partial write).
+    The temp file has a unique name, so concurrent writers never share it. Returns whether the write succeeded.
+    """
+    path = _profile_path(user_id)
+    tmp_path = None
     try:
-        with open(PROFILE_FILE, 'w', encoding='utf-8') as f:
-            json.dump(profiles, f, ensure_ascii=False, indent=4)
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=PROFILE_DIR, prefix=f".{user_id}.", suffix=".tmp")
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        return True
     except Exception as e:
-        logger.error(f"Failed to save profiles to '{PROFILE_FILE}': {e}", exc_info=True)
+        logger.error(f"Failed to save profile to '{path}': {e}", exc_info=True)
+        if tmp_path is not None:
+            try: os.remove(tmp_path)
+            except OSError: pass
+        return False
+
+def _write_profile_files(pending: List[Tuple[int, bytes]]) -> List[int]:
+    """Writes each pending profile; returns the user IDs whose write failed."""
+    return [user_id for user_id, data in pending if not _write_profile_file(user_id, data)]
+
+def _serialize_profile(profile: Dict[str, Any]) -> bytes:
+    return orjson.dumps(profile, option=orjson.OPT_INDENT_2)
 
 def get_user_profile(user_id: int, profiles: Dict[int, Dict[str, Any]]) -> Optional[Dict[str, Any]]:
     """Gets a specific user's profile."""
     return profiles.get(user_id)
 
 def update_user_profile(user_id: int, profiles: Dict[int, Dict[str, Any]], **kwargs) -> None:
-    """Creates or updates a user's profile data."""
+    """Creates or updates a user's profile data (written to disk by the next flush_user_profiles)."""
     if user_id not in profiles:
         profiles[user_id] = {}
     profiles[user_id].update(kwargs)
-    logger.info(f"Updated profile for user {user_id}. New data: {kwargs}")
-    save_user_profiles(profiles) # Save immediately
-
-def is_onboarding_complete(user_id: int, profiles: Dict[int, Dict[str, Any]]) -> bool:
-    """Checks if essential onboarding information (language, country, state/province) exists."""
-    profile = profiles.get(user_id, {})
-    # Define what constitutes "complete" onboarding
-    required_fields = ["language", "country", "state_province"]
-    return all(field in profile and profile[field] for field in required_fields)
\ No newline at end of file
+    _dirty_user_ids.add(user_id)
+    logger.info("Updated profile for user %d. New data: %s", user_id, kwargs)
+
+async def flush_user_profiles(profiles: Dict[int, Dict[str, Any]]) -> bool:
+    """Writes only the profiles changed since the last flush; returns whether a write happened."""
+    if not _dirty_user_ids:
+        return False
+    # Serialize on the event loop (handlers may mutate the dicts concurrently), then write files in a worker thread
+    pending = [(user_id, _serialize_profile(profiles[user_id])) for user_id in _dirty_user_ids if user_id in profiles]
+    _dirty_user_ids.clear() # Updates made while writing mark their IDs dirty again
+    failed = await asyncio.to_thread(_write_profile_files, pending)
+    if failed:
+        _dirty_user_ids.update(failed) # Retried on the next flush
+        logger.warning(f"{len(failed)} profile(s) failed to save; will retry on the next flush.")
+    return True
+
+# Define what constitutes "complete" onboarding
+REQUIRED_PROFILE_FIELDS = ("language", "country", "state_province")
+
+def is_profile_complete(profile: Optional[Dict[str, Any]]) -> bool:
+    """Checks an already-fetched profile for the essential onboarding fields."""
+    return profile is not None and all(profile.get(field) for field in REQUIRED_PROFILE_FIELDS)